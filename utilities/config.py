@@ -11,13 +11,38 @@ class Address(namedtuple('Address', ['host', 'port'])):
         return "%s:%d" % (self.host, self.port)
 
 
+class UnixAddress(namedtuple('UnixAddress', ['path'])):
+    def __repr__(self):
+        return "unix:%s" % self.path
+
+
 class ServiceCoord(namedtuple('ServiceCoord', ['name', 'shard'])):
     def __repr__(self) -> str:
         return "%s:%d" % (self.name, self.shard)
 
 
+def parse_address(value):
+    # Either [host, port] or "unix:/path/to/socket"
+    if isinstance(value, str):
+        if not value.startswith('unix:'):
+            raise ConfigError('Invalid address %r' % value)
+        return UnixAddress(value[len('unix:'):])
+    return Address(*value)
+
+
 def get_service_address(service_coord: ServiceCoord):
-    return Address(*config['services'][service_coord.name][int(service_coord.shard)])
+    return parse_address(config['services'][service_coord.name][int(service_coord.shard)])
+
+
+def get_shard_count(service_name):
+    return len(config['services'].get(service_name, []))
+
+
+def get_metrics_address(service_coord: ServiceCoord):
+    try:
+        return Address(*config['metrics'][service_coord.name][int(service_coord.shard)])
+    except (KeyError, IndexError):
+        return None
 
 
 config = json.load(open('config.json'))
@@ -1,8 +1,15 @@
+from datetime import datetime
+
 from . import db
 
-from pony.orm import Required
+from pony.orm import Required, Optional
 
 
 class Printing(db.Entity):
     caller = Required("User")
-    source = Required(str)
+    source = Required(str)  # Name of the file shown to the user, stored as <id>_<source>.
+    state = Required(str, default='uploading')  # uploading, queued, printing, done or failed.
+    created = Required(datetime, default=datetime.now)
+    started = Optional(datetime)  # When a spooler worker picked the job up.
+    finished = Optional(datetime)
+    error = Optional(str)  # Why the job failed.
@@ -1,3 +1,5 @@
+import multiprocessing
+
 import bcrypt
 
 from pony.orm import db_session
@@ -30,14 +32,42 @@ class User(db.Entity):
         self.ram = 0.0
 
     def before_insert(self):
-        self.password = "bcrypt:" + bcrypt.hashpw(self.password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        # Passwords hashed in bulk by provision_users arrive already hashed
+        if not self.password.startswith('bcrypt:'):
+            self.password = hash_password(self.password)
 
     def verify_password(self, password):
-        if self.password.startswith('bcrypt:'):
-            return bcrypt.checkpw(password.encode('utf-8'), self.password[7:].encode('utf-8'))
-        else:
-            return False
+        return check_password(self.password, password)
 
     def before_update(self):
         if not self.password.startswith('bcrypt:'):
-            self.password = "bcrypt:" + bcrypt.hashpw(self.password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+            self.password = hash_password(self.password)
+
+
+def hash_password(password):
+    return "bcrypt:" + bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
+
+def check_password(stored, password):
+    # stored is the value of User.password. Takes no entity, so it can run outside the db_session's thread.
+    if stored.startswith('bcrypt:'):
+        return bcrypt.checkpw(password.encode('utf-8'), stored[7:].encode('utf-8'))
+    else:
+        return False
+
+
+def provision_users(users, processes=None):
+    # Creates or updates users from (username, password, ip_address) tuples. Passwords are hashed on a process pool
+    # and every row is written in a single transaction. Returns the number of users written.
+    users = list(users)
+    with multiprocessing.Pool(processes) as pool:
+        passwords = pool.map(hash_password, [password for _username, password, _ip_address in users], chunksize=8)
+
+    with db_session:
+        for (username, _password, ip_address), password in zip(users, passwords):
+            user = User.get(username=username)
+            if user is None:
+                User(username=username, password=password, ip_address=ip_address)
+            else:
+                user.set(password=password, ip_address=ip_address)
+    return len(users)
@@ -0,0 +1,163 @@
+from gevent import monkey
+monkey.patch_all()
+
+import time  # noqa: E402
+
+import gevent  # noqa: E402
+
+from utilities.config import ServiceCoord  # noqa: E402
+from utilities.scripts.rpc_benchmark_common import SERVICE_NAME, ReportWriter, large_requests, parse_args, \
+    payload, report  # noqa: E402
+from utilities.services.base import Service  # noqa: E402
+from utilities.services.rpc import rpc_method, RPCServiceClient  # noqa: E402
+
+
+class BenchmarkService(Service):
+    @rpc_method
+    def echo(self, data=None):
+        return data
+
+
+def connect_clients(count, codecs, timeout=10):
+    clients = [RPCServiceClient(ServiceCoord(SERVICE_NAME, 0), auto_retry=0.1, codecs=codecs) for _ in range(count)]
+    for client in clients:
+        client.connect()
+    for client in clients:
+        if not client._connection_event.wait(timeout):
+            raise RuntimeError('Could not connect to %s' % SERVICE_NAME)
+    return clients
+
+
+def disconnect_clients(clients):
+    for client in clients:
+        client.disconnect()
+
+
+def timed_calls(client, method, params, count, latencies):
+    errors = 0
+    for _ in range(count):
+        started = time.perf_counter()
+        try:
+            client.execute_rpc(method, params).get()
+        except Exception:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - started)
+    return errors
+
+
+def run_sequential(scenario, rpc_clients, method, params, requests, **extra):
+    latencies = []
+    per_client = max(1, requests // len(rpc_clients))
+    started = time.perf_counter()
+    workers = [gevent.spawn(timed_calls, client, method, params, per_client, latencies) for client in rpc_clients]
+    gevent.joinall(workers)
+    elapsed = time.perf_counter() - started
+    return report(scenario, latencies, sum(worker.value or 0 for worker in workers), elapsed, **extra)
+
+
+def scenario_ping(args):
+    clients = connect_clients(1, args.codecs)
+    try:
+        return run_sequential('ping', clients, 'ping', {}, args.requests)
+    finally:
+        disconnect_clients(clients)
+
+
+def scenario_large(args):
+    clients = connect_clients(1, args.codecs)
+    data = payload(clients[0].codec, args.payload)
+    try:
+        return run_sequential('large', clients, 'echo', {'data': data}, large_requests(args),
+                              payload_bytes=args.payload)
+    finally:
+        disconnect_clients(clients)
+
+
+def scenario_pipelined(args):
+    clients = connect_clients(1, args.codecs)
+    client = clients[0]
+    latencies = []
+    errors = 0
+    try:
+        started = time.perf_counter()
+        for _ in range(max(1, args.requests // args.burst)):
+            sent = time.perf_counter()
+            results = client.execute_rpc_many([('ping', {})] * args.burst)
+            for result in results:
+                try:
+                    result.get()
+                except Exception:
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - sent)
+        elapsed = time.perf_counter() - started
+    finally:
+        disconnect_clients(clients)
+    return report('pipelined', latencies, errors, elapsed, burst=args.burst)
+
+
+def scenario_connections(args):
+    clients = connect_clients(args.clients, args.codecs)
+    try:
+        return run_sequential('connections', clients, 'ping', {}, args.requests, clients=args.clients)
+    finally:
+        disconnect_clients(clients)
+
+
+def scenario_reconnect(args):
+    clients = connect_clients(args.clients, args.codecs)
+    latencies = []
+    errors = 0
+
+    def reconnect(client):
+        client.disconnect()
+        began = time.perf_counter()
+        client.connect()
+        if not client._connection_event.wait(10):
+            return 1
+        try:
+            client.execute_rpc('ping', {}).get()
+        except Exception:
+            return 1
+        latencies.append(time.perf_counter() - began)
+        return 0
+
+    try:
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            workers = [gevent.spawn(reconnect, client) for client in clients]
+            gevent.joinall(workers)
+            errors += sum(worker.value or 0 for worker in workers)
+        elapsed = time.perf_counter() - started
+    finally:
+        disconnect_clients(clients)
+    return report('reconnect', latencies, errors, elapsed, clients=args.clients, rounds=args.rounds)
+
+
+SCENARIOS = {
+    'ping': scenario_ping,
+    'large': scenario_large,
+    'pipelined': scenario_pipelined,
+    'connections': scenario_connections,
+    'reconnect': scenario_reconnect,
+}
+
+
+def main():
+    args = parse_args('gevent')
+
+    service = BenchmarkService()
+    gevent.spawn(service.run)
+    gevent.sleep(0.1)
+
+    try:
+        with ReportWriter('gevent', args) as writer:
+            for name in args.scenarios.split(','):
+                writer.write(SCENARIOS[name](args))
+    finally:
+        service.exit()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+import asyncio
+import time
+
+from utilities.config import ServiceCoord
+from utilities.scripts.rpc_benchmark_common import SERVICE_NAME, ReportWriter, large_requests, parse_args, payload, \
+    report
+from utilities.services.aio import AsyncService, AsyncRPCServiceClient
+from utilities.services.dispatch import rpc_method
+
+# Same scenarios and output as rpc_benchmark, for the asyncio stack. Run both with the same arguments to compare them.
+
+
+class BenchmarkService(AsyncService):
+    @rpc_method
+    def echo(self, data=None):
+        return data
+
+
+async def connect_clients(count, codecs, timeout=10):
+    clients = [AsyncRPCServiceClient(ServiceCoord(SERVICE_NAME, 0), auto_retry=0.1, codecs=codecs)
+               for _ in range(count)]
+    for client in clients:
+        client.connect()
+    try:
+        await asyncio.gather(*[client.wait_connected(timeout) for client in clients])
+    except asyncio.TimeoutError:
+        raise RuntimeError('Could not connect to %s' % SERVICE_NAME)
+    return clients
+
+
+def disconnect_clients(clients):
+    for client in clients:
+        client.disconnect()
+
+
+async def timed_calls(client, method, params, count, latencies):
+    errors = 0
+    for _ in range(count):
+        started = time.perf_counter()
+        try:
+            await client.execute_rpc(method, params)
+        except Exception:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - started)
+    return errors
+
+
+async def run_sequential(scenario, rpc_clients, method, params, requests, **extra):
+    latencies = []
+    per_client = max(1, requests // len(rpc_clients))
+    started = time.perf_counter()
+    errors = await asyncio.gather(*[timed_calls(client, method, params, per_client, latencies)
+                                    for client in rpc_clients])
+    elapsed = time.perf_counter() - started
+    return report(scenario, latencies, sum(errors), elapsed, **extra)
+
+
+async def scenario_ping(args):
+    clients = await connect_clients(1, args.codecs)
+    try:
+        return await run_sequential('ping', clients, 'ping', {}, args.requests)
+    finally:
+        disconnect_clients(clients)
+
+
+async def scenario_large(args):
+    clients = await connect_clients(1, args.codecs)
+    data = payload(clients[0].codec, args.payload)
+    try:
+        return await run_sequential('large', clients, 'echo', {'data': data}, large_requests(args),
+                                    payload_bytes=args.payload)
+    finally:
+        disconnect_clients(clients)
+
+
+async def scenario_pipelined(args):
+    clients = await connect_clients(1, args.codecs)
+    client = clients[0]
+    latencies = []
+    errors = 0
+    try:
+        started = time.perf_counter()
+        for _ in range(max(1, args.requests // args.burst)):
+            sent = time.perf_counter()
+            for future in client.execute_rpc_many([('ping', {})] * args.burst):
+                try:
+                    await future
+                except Exception:
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - sent)
+        elapsed = time.perf_counter() - started
+    finally:
+        disconnect_clients(clients)
+    return report('pipelined', latencies, errors, elapsed, burst=args.burst)
+
+
+async def scenario_connections(args):
+    clients = await connect_clients(args.clients, args.codecs)
+    try:
+        return await run_sequential('connections', clients, 'ping', {}, args.requests, clients=args.clients)
+    finally:
+        disconnect_clients(clients)
+
+
+async def scenario_reconnect(args):
+    clients = await connect_clients(args.clients, args.codecs)
+    latencies = []
+    errors = 0
+
+    async def reconnect(client):
+        client.disconnect()
+        began = time.perf_counter()
+        client.connect()
+        try:
+            await client.wait_connected(10)
+            await client.execute_rpc('ping', {})
+        except Exception:
+            return 1
+        latencies.append(time.perf_counter() - began)
+        return 0
+
+    try:
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            errors += sum(await asyncio.gather(*[reconnect(client) for client in clients]))
+        elapsed = time.perf_counter() - started
+    finally:
+        disconnect_clients(clients)
+    return report('reconnect', latencies, errors, elapsed, clients=args.clients, rounds=args.rounds)
+
+
+SCENARIOS = {
+    'ping': scenario_ping,
+    'large': scenario_large,
+    'pipelined': scenario_pipelined,
+    'connections': scenario_connections,
+    'reconnect': scenario_reconnect,
+}
+
+
+async def run(args, writer):
+    service = BenchmarkService()
+    await service.start()
+    try:
+        for name in args.scenarios.split(','):
+            writer.write(await SCENARIOS[name](args))
+    finally:
+        service.exit()
+
+
+def main():
+    args = parse_args('asyncio')
+    with ReportWriter('asyncio', args) as writer:
+        asyncio.run(run(args, writer))
+
+
+if __name__ == '__main__':
+    main()
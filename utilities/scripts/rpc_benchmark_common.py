@@ -0,0 +1,84 @@
+import argparse
+import json
+import sys
+
+from utilities.config import config
+from utilities.services.metrics import percentile
+
+# Arguments, payloads and reports shared by rpc_benchmark (gevent) and rpc_benchmark_aio (asyncio), so both stacks
+# are measured and reported the same way. Imports nothing of either stack: gevent must not be monkey-patched here.
+
+SERVICE_NAME = 'BenchmarkService'
+
+SCENARIOS = ('ping', 'large', 'pipelined', 'connections', 'reconnect')
+
+
+def report(scenario, latencies, errors, elapsed, **extra):
+    latencies.sort()
+    result = {
+        'scenario': scenario,
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(elapsed, 6),
+        'throughput': round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'p999_ms': round(percentile(latencies, 0.999) * 1000, 3),
+    }
+    result.update(extra)
+    return result
+
+
+def payload(codec, size):
+    # bytes need a binary codec, JSON peers get the same amount of text
+    return 'x' * size if codec.name == 'json' else b'x' * size
+
+
+def large_requests(args):
+    return max(1, args.requests // 100)
+
+
+def parse_args(stack):
+    parser = argparse.ArgumentParser(description='Loopback benchmark of the %s RPC stack' % stack)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18800)
+    parser.add_argument('--unix', help='Serve on this unix socket path instead of host and port')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=10000)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--payload', type=int, default=512 * 1024)
+    parser.add_argument('--burst', type=int, default=500)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--codec', action='append', dest='codecs',
+                        help='Codec offered by the clients (repeatable), "none" for line-JSON')
+    parser.add_argument('--output', help='Write JSON lines here instead of stdout')
+    args = parser.parse_args()
+
+    if args.codecs == ['none']:
+        args.codecs = []
+    for name in args.scenarios.split(','):
+        if name not in SCENARIOS:
+            parser.error('Unknown scenario %s' % name)
+
+    config['services'][SERVICE_NAME] = ['unix:' + args.unix] if args.unix else [[args.host, args.port]]
+    return args
+
+
+class ReportWriter:
+    # JSON lines, one per scenario, to --output or stdout
+    def __init__(self, stack, args):
+        self.stack = stack
+        self.codecs = args.codecs
+        self.output = open(args.output, 'w') if args.output else sys.stdout
+
+    def write(self, result):
+        result = dict({'stack': self.stack}, **result, codecs=self.codecs)
+        self.output.write(json.dumps(result) + '\n')
+        self.output.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.output is not sys.stdout:
+            self.output.close()
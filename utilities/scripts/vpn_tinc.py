@@ -5,9 +5,8 @@ from os import path
 from csv import DictWriter, DictReader
 from ipaddress import ip_address
 
-from pony.orm import db_session
-
-from utilities.models import User
+from utilities.models.user import provision_users
+from utilities.services.directory import notify_users_changed
 
 RSA_LENGTH = 2048
 GLOBAL_PREFIX_WIDTH = 8
@@ -89,9 +88,9 @@ class VPNNode:
         return buffer.getvalue()
 
 
-@db_session
 def create_users() -> list[VPNNode]:
     user_nodes = []
+    users = []
     with open(path.join("data", "user.csv"), "r") as node_list_f:
         for node in DictReader(node_list_f):
             name, password = node["Name"], node["Password"]
@@ -105,7 +104,10 @@ def create_users() -> list[VPNNode]:
             user_nodes.append(VPNNode(name, password, expected_subnet_ip))
             print("Created user", name)
 
-            User(username=name, password=password, ip_address=expected_subnet_ip)
+            users.append((name, password, expected_subnet_ip))
+
+    # Hashes every password in parallel and writes all users in one transaction
+    print("Updated", provision_users(users), "users")
     return user_nodes
 
 
@@ -170,6 +172,7 @@ def write_services(service_nodes: list[VPNNode]):
 
 def create_all():
     user_nodes = create_users()
+    notify_users_changed()
     service_nodes = create_services()
 
     for service in service_nodes:
@@ -6,9 +6,8 @@ from csv import DictWriter, DictReader
 from ipaddress import ip_address
 import subprocess
 
-from pony.orm import db_session
-
-from utilities.models import User
+from utilities.models.user import provision_users
+from utilities.services.directory import notify_users_changed
 
 BASE_SUBNET = ip_address("10.0.0.0")
 USER_BASE_SUBNET = ip_address("10.0.0.0")
@@ -76,9 +75,9 @@ class VPNNode:
         peer_config += "\n"
         self.config += peer_config
 
-@db_session
 def create_users() -> list[VPNNode]:
     user_nodes = []
+    users = []
 
     with open(path.join("data", "user.csv"), "r") as node_list_f:
         for node in DictReader(node_list_f):
@@ -86,14 +85,10 @@ def create_users() -> list[VPNNode]:
             subnet_ip = node["SubnetIP"]
 
             user_nodes.append(VPNNode(name, password, subnet_ip))
+            users.append((name, password, subnet_ip))
 
-            if User.select(lambda u: u.username == name).count() == 0:
-                User(username=name, password=password, ip_address=subnet_ip)
-            else:
-                user = User.select(lambda u: u.username == name).first()
-                user.password = password
-                user.ip_address = subnet_ip
-
+    # Hashes every password in parallel and writes all users in one transaction
+    print("Updated", provision_users(users), "users")
     return user_nodes
 
 
@@ -111,6 +106,7 @@ def create_services() -> list[VPNNode]:
 
 def create_all():
     user_nodes = create_users()
+    notify_users_changed()
     service_nodes = create_services()
     central = service_nodes[0]
     service_nodes = service_nodes[1:]
@@ -0,0 +1,1221 @@
+import asyncio
+import collections
+import functools
+import heapq
+import inspect
+import itertools
+import os
+import random
+import signal
+import time
+
+from .codec import FRAME_HEADER, LINE_DELIMITER, PREFERRED_CODECS, STREAM_CHUNK_ITEMS, STREAM_WINDOW, CodecError, \
+    JSONCodec, choose_codec, hello_request, hello_response, is_hello, negotiated_codec
+from .core import Address, RPCError, RPCTimeout, RPCStreamCancelled, ServiceCore, reuse_port_listener, \
+    unix_listener
+from .dispatch import PERMISSION_LEVELS, build_dispatch_table, load_permissions
+from .metrics import RPCLoad, RPCMetrics
+from ..config import get_service_address, ConfigError, ServiceCoord, UnixAddress
+
+# asyncio implementation of the RPC stack. It speaks the same wire protocol as rpc.py, so asyncio and gevent
+# services and clients can be mixed freely. rpc_method works unchanged, methods may also be coroutine functions
+# (awaited) or async generators (streamed like generators).
+
+
+class PendingRequest:
+    __slots__ = ('method', 'future', 'deadline', 'started', 'stats')
+
+    def __init__(self, method, future, deadline, stats):
+        self.method = method
+        self.future = future
+        self.deadline = deadline
+        self.started = time.monotonic()
+        self.stats = stats
+
+
+class StreamCredit:
+    __slots__ = ('credits', 'cancelled', 'event')
+
+    def __init__(self, credits):
+        self.credits = credits
+        self.cancelled = False
+        self.event = asyncio.Event()
+
+    def add(self, credits):
+        self.credits += credits
+        self.event.set()
+
+    def cancel(self):
+        self.cancelled = True
+        self.event.set()
+
+
+def _spawn(handler, *args):
+    # Handlers may be plain functions or coroutine functions
+    try:
+        result = handler(*args)
+    except Exception as error:
+        print("Handler %r failed: %s" % (handler, error))
+        return
+    if inspect.isawaitable(result):
+        asyncio.ensure_future(result)
+
+
+async def _iterate(iterator):
+    if inspect.isasyncgen(iterator):
+        async for item in iterator:
+            yield item
+    else:
+        for item in iterator:
+            yield item
+
+
+class AsyncRPCConnection(asyncio.Protocol):
+    MAX_MESSAGE_SIZE = 1024 * 1024  # 1 MB, line-JSON messages
+    MAX_FRAME_SIZE = 64 * 1024 * 1024  # 64 MB, length-prefixed frames
+
+    def __init__(self, remote_address=None):
+        self.remote_address = remote_address
+        self.transport = None
+        self.last_received = 0.0
+
+        # Until a peer negotiates the framed protocol, messages are JSON lines
+        self.codec = JSONCodec
+        self.framed = False
+
+        self._buffer = bytearray()
+
+        # Messages sent during the same loop iteration are written together
+        self._outbox = []
+        self._flush_scheduled = False
+        self._writable = None
+
+    @property
+    def connected(self):
+        return self.transport is not None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.last_received = time.monotonic()
+        self.codec = JSONCodec
+        self.framed = False
+        self._buffer.clear()
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self._outbox = []
+        # Wake up anyone waiting for the write buffer to drain, they check connected afterwards
+        self._writable.set()
+
+    def pause_writing(self):
+        self._writable.clear()
+
+    def resume_writing(self):
+        self._writable.set()
+
+    def disconnect(self):
+        return self._close()
+
+    def _close(self):
+        if self.transport is None:
+            return False
+        self.transport.close()
+        return True
+
+    def data_received(self, data):
+        self.last_received = time.monotonic()
+        buffer = self._buffer
+        buffer += data
+
+        position = 0
+        while self.transport is not None:
+            if self.framed:
+                if len(buffer) - position < FRAME_HEADER.size:
+                    break
+                length, = FRAME_HEADER.unpack_from(buffer, position)
+                if length > self.MAX_FRAME_SIZE:
+                    self.disconnect()
+                    return
+                start = position + FRAME_HEADER.size
+                if len(buffer) < start + length:
+                    break
+                payload = bytes(buffer[start:start + length])
+                position = start + length
+            else:
+                end = buffer.find(LINE_DELIMITER, position)
+                if end < 0:
+                    if len(buffer) - position > self.MAX_MESSAGE_SIZE:
+                        self.disconnect()
+                        return
+                    break
+                payload = bytes(buffer[position:end])
+                position = end + len(LINE_DELIMITER)
+
+            try:
+                message = self.codec.loads(payload)
+            except CodecError:
+                self.disconnect()
+                return
+
+            # May switch the framing for the rest of the buffer, see accept_hello
+            self.process_message(message, len(payload))
+
+        del buffer[:position]
+
+    def process_message(self, message, size):
+        raise NotImplementedError
+
+    def _frame(self, data):
+        if self.framed:
+            return [FRAME_HEADER.pack(len(data)), data]
+        if len(data) > self.MAX_MESSAGE_SIZE:
+            raise CodecError('Message too long for a line-JSON peer')
+        return [data, LINE_DELIMITER]
+
+    def send(self, data):
+        if self.transport is None:
+            return False
+        try:
+            self._outbox.extend(self._frame(data))
+        except CodecError:
+            return False
+
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+        return True
+
+    def _flush(self):
+        self._flush_scheduled = False
+        outbox, self._outbox = self._outbox, []
+        if outbox and self.transport is not None:
+            self.transport.write(b''.join(outbox))
+
+
+class AsyncRPCServiceServer(AsyncRPCConnection):
+    def __init__(self, local_service):
+        super().__init__()
+        self.local_service = local_service
+        self.permission_level = 0
+
+        self.load = RPCLoad()
+        self._tasks = set()
+        self._slots = asyncio.Semaphore(local_service.MAX_CONNECTION_CONCURRENCY)
+        # Tasks of streams that gave their slots back while waiting for credits, see _wait_for_credits
+        self._slotless = set()
+        self._reading_paused = False
+
+        # Credits of the responses currently being streamed, by request id
+        self._streams = dict()
+
+        self.heartbeats = False
+
+        # Events that did not fit in the transport's write buffer, the oldest are dropped when a subscriber lags
+        self.topics = set()
+        self._events = collections.deque(maxlen=local_service.MAX_SUBSCRIBER_BUFFER)
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+
+        peer = transport.get_extra_info('peername')
+        if isinstance(peer, tuple):
+            self.remote_address = Address(peer[0], peer[1])
+        else:
+            # Peers of a unix socket have no address, the socket file's permissions restrict who can connect
+            self.remote_address = Address('unix', 0)
+        print("Client connected: %s:%s" % (self.remote_address.host, self.remote_address.port))
+
+        self.permission_level = PERMISSION_LEVELS[self.local_service.get_permission(self.remote_address)]
+        self.local_service.rpc_connections.add(self)
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        self.local_service.rpc_connections.discard(self)
+
+        for stream in self._streams.values():
+            stream.cancel()
+        self._streams.clear()
+
+        self.local_service.unsubscribe(self, self.topics)
+        self.topics.clear()
+        self._events.clear()
+
+        for task in list(self._tasks):
+            task.cancel()
+
+    @property
+    def stalled(self):
+        # The client's heartbeats are not read meanwhile
+        return self._reading_paused
+
+    def _update_load(self, name, delta):
+        setattr(self.load, name, getattr(self.load, name) + delta)
+        service_load = self.local_service.rpc_load
+        setattr(service_load, name, getattr(service_load, name) + delta)
+
+    def process_message(self, message, size):
+        if not self.framed and is_hello(message):
+            self.accept_hello(message)
+            return
+
+        if isinstance(message, dict):
+            if '__credit' in message or '__cancel' in message:
+                self.process_stream_control(message)
+                return
+            if '__subscribe' in message or '__unsubscribe' in message:
+                self.process_subscription(message)
+                return
+            if '__heartbeat' in message:
+                # Clients that send heartbeats are dropped by the service once they stop
+                self.heartbeats = True
+                self.send(self.codec.dumps(message))
+                return
+
+        # Batches arrive as a single frame holding a list of requests
+        if isinstance(message, list):
+            for request in message:
+                self._enqueue(request, size // len(message))
+        else:
+            self._enqueue(message, size)
+
+    def _enqueue(self, request, size):
+        if self._slots.locked() or self.local_service.rpc_slots.locked():
+            self._update_load('deferred', 1)
+        self._update_load('queued', 1)
+
+        task = asyncio.get_running_loop().create_task(self._process_queued_request(request, time.monotonic(), size))
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+        # Stop reading once too many requests wait for a slot, TCP flow control then pushes back on the client.
+        # Streams waiting for credits do not count, the credits may be behind the requests not read yet.
+        if len(self._tasks) - len(self._slotless) >= self.local_service.MAX_CONNECTION_CONCURRENCY + \
+                self.local_service.MAX_CONNECTION_QUEUE and not self._reading_paused:
+            self._reading_paused = True
+            self._update_load('stalled', 1)
+            self.transport.pause_reading()
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        self._resume_reading()
+
+    def _resume_reading(self):
+        if self._reading_paused and len(self._tasks) - len(self._slotless) < \
+                self.local_service.MAX_CONNECTION_CONCURRENCY and self.transport is not None:
+            self._reading_paused = False
+            # Whatever the client sent meanwhile is still unread, the silence was ours
+            self.last_received = time.monotonic()
+            self.transport.resume_reading()
+
+    async def _acquire_slots(self):
+        await self._slots.acquire()
+        try:
+            await self.local_service.rpc_slots.acquire()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _release_slots(self):
+        self.local_service.rpc_slots.release()
+        self._slots.release()
+
+    async def _process_queued_request(self, request, received, size):
+        try:
+            await self._acquire_slots()
+        except asyncio.CancelledError:
+            self._update_load('queued', -1)
+            self._update_load('rejected', 1)
+            return
+
+        self._update_load('queued', -1)
+        self._update_load('running', 1)
+        task = asyncio.current_task()
+        try:
+            await self.process_incoming_request(request, received, size)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._update_load('running', -1)
+            if task in self._slotless:
+                self._slotless.discard(task)
+            else:
+                self._release_slots()
+
+    def accept_hello(self, request):
+        params = request.get('__params')
+        codec = choose_codec(params.get('codecs') if isinstance(params, dict) else None)
+        if codec is None:
+            response = {'__id': request.get('__id'), '__data': None, '__error': 'No common codec'}
+        else:
+            response = hello_response(codec)
+
+        # Still in line mode, and nothing else was sent yet
+        self.send(JSONCodec.dumps(response))
+        if codec is not None:
+            self.codec = codec
+            self.framed = True
+
+    async def process_incoming_request(self, request, received=None, size=0):
+        if not isinstance(request, dict) or not {'__id', '__method', '__params'}.issubset(request.keys()):
+            self.disconnect()
+            return
+
+        id_ = request['__id']
+        if received is None:
+            received = time.monotonic()
+
+        # The client sends the time it is still willing to wait, which is turned into a local deadline
+        remaining = request.get('__timeout')
+        if isinstance(remaining, (int, float)):
+            remaining -= time.monotonic() - received
+            if remaining <= 0:
+                # Nobody is waiting for this answer any more
+                self._update_load('expired', 1)
+                return
+        else:
+            remaining = None
+
+        response = {
+            '__id': id_,
+            '__data': None,
+            '__error': None
+        }
+
+        method = self.local_service.rpc_methods.get(request['__method'])
+
+        # Unknown method names are not recorded, so clients cannot grow the metrics without bound
+        stats = None if method is None else self.local_service.rpc_metrics.method(method.name)
+        if stats is not None:
+            stats.calls += 1
+            stats.bytes_in += size
+
+        if method is None:
+            response['__error'] = 'Method not found'
+        elif method.level > self.permission_level:
+            response['__error'] = 'Permission denied'
+        elif not method.accepts(request['__params']):
+            response['__error'] = 'Invalid parameters'
+        else:
+            stats.in_flight += 1
+            try:
+                value = await asyncio.wait_for(self._call(method, request['__params']), remaining)
+                if inspect.isgenerator(value) or inspect.isasyncgen(value):
+                    await self._stream_response(id_, value, stats)
+                    return
+                response['__data'] = value
+            except asyncio.TimeoutError as error:
+                if remaining is not None and time.monotonic() - received >= remaining:
+                    stats.errors += 1
+                    self._update_load('expired', 1)
+                    return
+                response['__error'] = "%s: %s" % (error.__class__.__name__, error)
+            except Exception as error:
+                response['__error'] = "%s: %s\n%s" % (error.__class__.__name__, error, error.__traceback__)
+            finally:
+                stats.in_flight -= 1
+                stats.latency.record(time.monotonic() - received)
+
+        try:
+            data = self.codec.dumps(response)
+        except CodecError:
+            if stats is not None:
+                stats.errors += 1
+            return
+
+        if stats is not None:
+            stats.bytes_out += len(data)
+            if response['__error'] is not None:
+                stats.errors += 1
+
+        self.send(data)
+
+    async def _call(self, method, params):
+        if method.cache is not None:
+            return await method.cache.get_async(method.cache_key(params),
+                                                functools.partial(self._invoke, method, params))
+        return await self._invoke(method, params)
+
+    async def _invoke(self, method, params):
+        value = method.call(params)
+        if inspect.isawaitable(value):
+            value = await value
+        if not self.framed:
+            # Line-JSON peers cannot receive streams, they get the whole result at once
+            if inspect.isgenerator(value):
+                value = list(value)
+            elif inspect.isasyncgen(value):
+                value = [item async for item in value]
+        return value
+
+    def process_stream_control(self, message):
+        stream = self._streams.get(message.get('__id'))
+        if stream is None:
+            return
+
+        if message.get('__cancel'):
+            stream.cancel()
+        elif isinstance(message.get('__credit'), int):
+            stream.add(message['__credit'])
+
+    def process_subscription(self, message):
+        topics = message.get('__subscribe') or message.get('__unsubscribe')
+        if not isinstance(topics, list) or not all(isinstance(topic, str) for topic in topics):
+            return
+
+        if '__subscribe' in message:
+            self.topics.update(topics)
+            self.local_service.subscribe(self, topics)
+        else:
+            self.topics.difference_update(topics)
+            self.local_service.unsubscribe(self, topics)
+
+    def push_event(self, data):
+        if self.transport is None:
+            return
+
+        # Events go straight to the transport while it keeps up, and wait in the bounded buffer while it is paused
+        if self._writable.is_set() and not self._events:
+            if self.send(data):
+                self._update_load('events_sent', 1)
+            return
+
+        if len(self._events) == self._events.maxlen:
+            self._update_load('events_dropped', 1)
+        self._events.append(data)
+
+    def resume_writing(self):
+        super().resume_writing()
+
+        events = list(self._events)
+        self._events.clear()
+        for data in events:
+            self.send(data)
+        self._update_load('events_sent', len(events))
+
+    async def _stream_response(self, id_, iterator, stats):
+        stream = StreamCredit(STREAM_WINDOW)
+        self._streams[id_] = stream
+
+        error = None
+        try:
+            chunk = []
+            async for item in _iterate(iterator):
+                chunk.append(item)
+                if len(chunk) >= STREAM_CHUNK_ITEMS:
+                    await self._send_stream_chunk(id_, stream, chunk, stats)
+                    chunk = []
+            if chunk:
+                await self._send_stream_chunk(id_, stream, chunk, stats)
+        except RPCStreamCancelled:
+            return
+        except Exception as error_:
+            error = "%s: %s" % (error_.__class__.__name__, error_)
+            stats.errors += 1
+        finally:
+            if inspect.isasyncgen(iterator):
+                await iterator.aclose()
+            else:
+                iterator.close()
+            self._streams.pop(id_, None)
+
+        data = self.codec.dumps({'__id': id_, '__data': None, '__error': error, '__stream': False})
+        stats.bytes_out += len(data)
+        self.send(data)
+
+    async def _send_stream_chunk(self, id_, stream, chunk, stats):
+        if stream.credits <= 0 and not stream.cancelled:
+            await self._wait_for_credits(stream)
+        # Credits only bound what the client buffers, the transport's buffer has to drain as well
+        await self._writable.wait()
+        if stream.cancelled or self.transport is None:
+            raise RPCStreamCancelled()
+
+        stream.credits -= 1
+        data = self.codec.dumps({'__id': id_, '__data': chunk, '__error': None, '__stream': True})
+        stats.bytes_out += len(data)
+        self.send(data)
+
+    async def _wait_for_credits(self, stream):
+        # The slots are given back while waiting, and the stream no longer counts towards pausing the reads: the
+        # credits may be behind requests waiting for a slot. A client that stops reading a stream without closing
+        # it gets it cancelled after STREAM_IDLE_TIMEOUT.
+        task = asyncio.current_task()
+        self._release_slots()
+        self._slotless.add(task)
+        self._update_load('running', -1)
+        self._update_load('waiting', 1)
+        self._resume_reading()
+        try:
+            timeout = self.local_service.STREAM_IDLE_TIMEOUT
+            try:
+                await asyncio.wait_for(self._credited(stream), timeout)
+            except asyncio.TimeoutError:
+                raise RPCTimeout('No credits for %d seconds' % timeout)
+        finally:
+            self._update_load('waiting', -1)
+            self._update_load('running', 1)
+
+        # Left in _slotless if cancelled while waiting for the slots, so that they are not released twice
+        await self._acquire_slots()
+        self._slotless.discard(task)
+
+    @staticmethod
+    async def _credited(stream):
+        while stream.credits <= 0 and not stream.cancelled:
+            stream.event.clear()
+            await stream.event.wait()
+
+    def send_heartbeat(self):
+        # Sent by the service while reading is paused, so the client does not take the connection for dead
+        try:
+            self.send(self.codec.dumps({'__heartbeat': None}))
+        except CodecError:
+            pass
+
+
+class AsyncRPCServiceClient(AsyncRPCConnection):
+    HANDSHAKE_TIMEOUT = 5
+
+    CONNECTION_STATES = ('disconnected', 'connecting', 'connected', 'backoff')
+
+    def __init__(self, remote_service_coord, auto_retry=None, codecs=None, timeout=None,
+                 heartbeat=2.0, liveness=6.0, max_retry=30.0):
+        super().__init__(get_service_address(remote_service_coord))
+
+        self.remote_service_coord = remote_service_coord
+
+        self._on_connect_handlers = list()
+        self._on_disconnect_handlers = list()
+
+        self.pending_outgoing_requests = dict()
+        self._request_ids = itertools.count(1)
+        # Streams whose first chunk arrived, by request id
+        self._streams = dict()
+
+        # Default deadline in seconds for every call to this service, None waits forever
+        self.timeout = timeout
+        # Heap of (deadline, id) shared by all calls, expired by a single timer on the loop's clock
+        self._deadlines = []
+        self._sweeper = None
+
+        self.metrics = RPCMetrics()
+
+        # Handlers of the topics this client subscribed to, subscriptions are renewed on every (re)connection
+        self._subscriptions = dict()
+
+        self.auto_retry = auto_retry
+        self.max_retry = max_retry
+        # Codecs offered to the server, most preferred first. An empty list keeps the legacy line-JSON protocol.
+        self.codecs = PREFERRED_CODECS if codecs is None else codecs
+
+        self.heartbeat_interval = heartbeat
+        self.liveness_timeout = liveness
+        self.heartbeat_timeouts = 0
+        self.heartbeat_rtt = None
+        self._heartbeat = None
+
+        self.state = 'disconnected'
+        self.state_transitions = {state: 0 for state in self.CONNECTION_STATES}
+        self._on_state_change_handlers = list()
+
+        self._loop = None
+        # Resolved once the hello was answered, and once the connection is lost
+        self._handshake = None
+        self._lost = None
+        self._ready = asyncio.Event()
+
+    @property
+    def connected(self):
+        return self._ready.is_set()
+
+    def add_on_connect_handler(self, handler):
+        self._on_connect_handlers.append(handler)
+
+    def add_on_disconnect_handler(self, handler):
+        self._on_disconnect_handlers.append(handler)
+
+    def add_on_state_change_handler(self, handler):
+        self._on_state_change_handlers.append(handler)
+
+    def _set_state(self, state):
+        previous, self.state = self.state, state
+        self.state_transitions[state] += 1
+        for handler in self._on_state_change_handlers:
+            _spawn(handler, previous, state)
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_retry, self.auto_retry * 2 ** (attempt - 1)))
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        loop = asyncio.get_running_loop()
+        self._lost = loop.create_future()
+
+        if self.codecs:
+            transport.write(JSONCodec.dumps(hello_request(self.codecs)) + LINE_DELIMITER)
+        else:
+            self._handshake.set_result(None)
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        self._ready.clear()
+
+        if not self._handshake.done():
+            self._handshake.set_exception(OSError('Handshake failed'))
+        if not self._lost.done():
+            self._lost.set_result(None)
+
+        pending_requests = list(self.pending_outgoing_requests.values())
+        self.pending_outgoing_requests.clear()
+        self._deadlines.clear()
+
+        streams = list(self._streams.values())
+        self._streams.clear()
+
+        for pending in pending_requests:
+            self._complete(pending, error=RPCError())
+
+        for stream in streams:
+            stream.finish(RPCError('Connection lost'))
+
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+
+    async def _connect(self):
+        if self._lost is not None and not self._lost.done():
+            # The protocol object is reused, the previous transport has to be gone first
+            await self._lost
+
+        loop = asyncio.get_running_loop()
+        self._handshake = loop.create_future()
+
+        if isinstance(self.remote_address, UnixAddress):
+            # Co-located services skip name resolution and the TCP stack
+            await loop.create_unix_connection(lambda: self, self.remote_address.path)
+        else:
+            await loop.create_connection(lambda: self, self.remote_address.host, self.remote_address.port)
+
+        try:
+            await asyncio.wait_for(asyncio.shield(self._handshake), self.HANDSHAKE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._close()
+            raise OSError('Handshake timed out')
+
+    async def _run(self):
+        attempt = 0
+        while True:
+            self._set_state('connecting')
+            try:
+                await self._connect()
+            except OSError:
+                pass
+            else:
+                attempt = 0
+                self._ready.set()
+                self._set_state('connected')
+                self._renew_subscriptions()
+                for handler in self._on_connect_handlers:
+                    _spawn(handler, self.remote_address)
+                if self.heartbeat_interval is not None:
+                    self._heartbeat = asyncio.ensure_future(self._send_heartbeats())
+
+                await self._lost
+                for handler in self._on_disconnect_handlers:
+                    _spawn(handler)
+
+            self._set_state('disconnected')
+            if self.auto_retry is None:
+                break
+
+            attempt += 1
+            self._set_state('backoff')
+            await asyncio.sleep(self._backoff(attempt))
+
+    async def _send_heartbeats(self):
+        while self.connected:
+            await asyncio.sleep(self.heartbeat_interval)
+            if not self.connected:
+                break
+
+            silence = time.monotonic() - self.last_received
+            if silence > self.liveness_timeout:
+                self.heartbeat_timeouts += 1
+                print("No data from %s for %.1fs, reconnecting" % (self.remote_address, silence))
+                self._heartbeat = None
+                self._close()
+                break
+
+            if self.framed:
+                self.send(self.codec.dumps({'__heartbeat': time.monotonic()}))
+            else:
+                # Line-JSON servers do not know heartbeats, but every service answers ping
+                self.execute_rpc('ping', {}, timeout=self.liveness_timeout)
+
+    def connection_stats(self):
+        return {
+            'state': self.state,
+            'transitions': dict(self.state_transitions),
+            'heartbeat_timeouts': self.heartbeat_timeouts,
+            'heartbeat_rtt': self.heartbeat_rtt,
+        }
+
+    def connect(self):
+        # Must be called from a running event loop
+        if self._loop is not None and not self._loop.done():
+            raise RuntimeError('Service already (re)connecting')
+        self._loop = asyncio.ensure_future(self._run())
+
+    async def wait_connected(self, timeout=None):
+        await asyncio.wait_for(self._ready.wait(), timeout)
+
+    def disconnect(self):
+        if self._loop is not None and not self._loop.done():
+            self._loop.cancel()
+            self._loop = None
+            self._set_state('disconnected')
+        return self._close()
+
+    def process_message(self, message, size):
+        if not self._handshake.done():
+            # Answer to the hello, a legacy server's "Method not found" keeps line-JSON
+            codec = negotiated_codec(message)
+            if codec is not None:
+                self.codec = codec
+                self.framed = True
+            self._handshake.set_result(None)
+            return
+
+        if isinstance(message, dict) and '__event' in message:
+            self.process_event(message)
+        elif isinstance(message, dict) and '__heartbeat' in message:
+            if isinstance(message['__heartbeat'], float):
+                self.heartbeat_rtt = time.monotonic() - message['__heartbeat']
+        elif isinstance(message, list):
+            for response in message:
+                self.process_incoming_response(response, size // len(message))
+        else:
+            self.process_incoming_response(message, size)
+
+    def process_event(self, event):
+        topic = event['__event']
+        for handler in self._subscriptions.get(topic, ()):
+            _spawn(handler, topic, event.get('__data'))
+
+    def subscribe(self, topic, handler):
+        handlers = self._subscriptions.setdefault(topic, [])
+        handlers.append(handler)
+        if len(handlers) == 1 and self.connected:
+            self._send_subscription('__subscribe', [topic])
+
+    def unsubscribe(self, topic, handler=None):
+        handlers = self._subscriptions.get(topic, [])
+        if handler is not None and handler in handlers:
+            handlers.remove(handler)
+        if handler is None or not handlers:
+            self._subscriptions.pop(topic, None)
+            if self.connected:
+                self._send_subscription('__unsubscribe', [topic])
+
+    def _renew_subscriptions(self):
+        if self._subscriptions:
+            self._send_subscription('__subscribe', list(self._subscriptions))
+
+    def _send_subscription(self, kind, topics):
+        if not self.framed:
+            print("Cannot subscribe to %s: %s only speaks line-JSON" % (topics, self.remote_address))
+            return
+        self.send(self.codec.dumps({kind: topics}))
+
+    def process_incoming_response(self, response, size=0):
+        if not isinstance(response, dict) or not {'__id', '__data', '__error'}.issubset(response.keys()):
+            self.disconnect()
+            return
+
+        if '__stream' in response:
+            self.process_stream_response(response, size)
+            return
+
+        pending = self.pending_outgoing_requests.pop(response['__id'], None)
+        if pending is None:
+            return
+
+        error = response['__error']
+
+        if error is not None:
+            error_msg = "%s signaled RPC for %s: %s" % (self.remote_address, pending.method, error)
+            self._complete(pending, size, error=RPCError(error_msg))
+        else:
+            self._complete(pending, size, value=response['__data'])
+
+    def _register(self, id_, pending, size):
+        pending.stats.calls += 1
+        pending.stats.in_flight += 1
+        pending.stats.bytes_out += size
+        self.pending_outgoing_requests[id_] = pending
+
+    def _complete(self, pending, size=0, error=None, value=None):
+        stats = pending.stats
+        stats.in_flight -= 1
+        stats.bytes_in += size
+        stats.latency.record(time.monotonic() - pending.started)
+
+        if pending.future.done():
+            # Cancelled by the caller
+            return
+        if error is not None:
+            stats.errors += 1
+            pending.future.set_exception(error)
+        else:
+            pending.future.set_result(value)
+
+    def process_stream_response(self, response, size=0):
+        id_ = response['__id']
+
+        stream = self._streams.get(id_)
+        if stream is None:
+            pending = self.pending_outgoing_requests.pop(id_, None)
+            if pending is None:
+                return
+            # The call resolves to the stream as soon as its first frame arrives, so its deadline no longer applies
+            stream = AsyncRPCStream(self, id_, pending.method, pending.stats)
+            self._streams[id_] = stream
+            self._complete(pending, value=stream)
+
+        stream.stats.bytes_in += size
+
+        if response['__stream']:
+            stream.feed(response['__data'])
+        else:
+            del self._streams[id_]
+            error = response['__error']
+            if error is not None:
+                stream.stats.errors += 1
+                error = RPCError("%s signaled RPC for %s: %s" % (self.remote_address, stream.method, error))
+            stream.finish(error)
+
+    def _send_stream_control(self, id_, **control):
+        if id_ not in self._streams:
+            return
+        control = {'__' + key: value for key, value in control.items()}
+        control['__id'] = id_
+        self.send(self.codec.dumps(control))
+
+    def _add_deadline(self, deadline, id_):
+        heapq.heappush(self._deadlines, (deadline, id_))
+
+        # Entries of answered requests are left in the heap, drop them once they dominate it
+        if len(self._deadlines) > 2 * len(self.pending_outgoing_requests) + 64:
+            self._deadlines = [(deadline_, id__) for deadline_, id__ in self._deadlines
+                               if id__ in self.pending_outgoing_requests]
+            heapq.heapify(self._deadlines)
+
+        if self._sweeper is None or self._deadlines[0][1] == id_:
+            self._schedule_sweep()
+
+    def _schedule_sweep(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        if self._deadlines:
+            self._sweeper = asyncio.get_running_loop().call_at(self._deadlines[0][0], self._sweep)
+
+    def _sweep(self):
+        self._sweeper = None
+        now = asyncio.get_running_loop().time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, id_ = heapq.heappop(self._deadlines)
+            pending = self.pending_outgoing_requests.get(id_)
+            if pending is not None and pending.deadline == deadline:
+                del self.pending_outgoing_requests[id_]
+                self._complete(pending, error=RPCTimeout(
+                    "%s timed out RPC for %s" % (self.remote_address, pending.method)))
+        self._schedule_sweep()
+
+    def _make_request(self, method, data, timeout):
+        request = {
+            '__id': next(self._request_ids),
+            '__method': method,
+            '__params': data
+        }
+
+        if timeout is None:
+            timeout = self.timeout
+
+        # Deadlines are on the loop's clock, so the sweeper can be scheduled with call_at
+        deadline = None
+        if timeout is not None:
+            request['__timeout'] = timeout
+            deadline = asyncio.get_running_loop().time() + timeout
+
+        return request, deadline
+
+    def execute_rpc(self, method, data, timeout=None):
+        # Returns a future, calls made during the same loop iteration go out in one write
+        request, deadline = self._make_request(method, data, timeout)
+        id_ = request['__id']
+
+        future = asyncio.get_running_loop().create_future()
+
+        try:
+            data = self.codec.dumps(request)
+        except CodecError:
+            future.set_exception(RPCError('Serialization error'))
+            return future
+
+        pending = PendingRequest(method, future, deadline, self.metrics.method(method))
+        self._register(id_, pending, len(data))
+
+        if not self.connected or not self.send(data):
+            del self.pending_outgoing_requests[id_]
+            self._complete(pending, error=RPCError('Write error'))
+            return future
+
+        if deadline is not None:
+            self._add_deadline(deadline, id_)
+
+        return future
+
+    def execute_rpc_many(self, calls, timeout=None):
+        # calls is an iterable of (method, params) pairs, sent in one frame (or one write for line-JSON peers)
+        loop = asyncio.get_running_loop()
+        futures = []
+        requests = []
+        for method, data in calls:
+            request, deadline = self._make_request(method, data, timeout)
+            future = loop.create_future()
+            futures.append(future)
+            requests.append((request, PendingRequest(method, future, deadline, self.metrics.method(method))))
+
+        if not requests:
+            return futures
+
+        try:
+            if self.framed:
+                datas = [self.codec.dumps([request for request, _pending in requests])]
+            else:
+                datas = [self.codec.dumps(request) for request, _pending in requests]
+        except CodecError:
+            for future in futures:
+                future.set_exception(RPCError('Serialization error'))
+            return futures
+
+        size = sum(len(data) for data in datas) // len(requests)
+        for request, pending in requests:
+            self._register(request['__id'], pending, size)
+
+        if not self.connected or not all(self.send(data) for data in datas):
+            for request, pending in requests:
+                if self.pending_outgoing_requests.pop(request['__id'], None) is not None:
+                    self._complete(pending, error=RPCError('Write error'))
+            return futures
+
+        for request, pending in requests:
+            if pending.deadline is not None:
+                self._add_deadline(pending.deadline, request['__id'])
+
+        return futures
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+
+        def remote_method(**data):
+            timeout = data.pop("timeout", None)
+            return self.execute_rpc(method, data, timeout=timeout)
+
+        return remote_method
+
+
+class AsyncRPCStream:
+    # Async iterator over the items streamed back by a generator rpc_method, see RPCStream
+    def __init__(self, client, id_, method, stats):
+        self._client = client
+        self._id = id_
+        self.method = method
+        self.stats = stats
+
+        self._chunks = collections.deque()
+        self._items = collections.deque()
+        self._consumed = 0
+        self._finished = False
+        self._error = None
+        self._event = asyncio.Event()
+
+    def feed(self, chunk):
+        self._chunks.append(chunk)
+        self._event.set()
+
+    def finish(self, error=None):
+        self._finished = True
+        self._error = error
+        self._event.set()
+
+    def close(self):
+        if not self._finished:
+            self._client._send_stream_control(self._id, cancel=True)
+            self._client._streams.pop(self._id, None)
+            self.finish()
+        self._chunks.clear()
+        self._items.clear()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._items:
+            if self._chunks:
+                self._items.extend(self._chunks.popleft())
+                self._consumed += 1
+                if self._consumed >= STREAM_WINDOW // 2 and not self._finished:
+                    self._client._send_stream_control(self._id, credit=self._consumed)
+                    self._consumed = 0
+            elif self._finished:
+                if self._error is not None:
+                    raise self._error
+                raise StopAsyncIteration
+            else:
+                self._event.clear()
+                await self._event.wait()
+        return self._items.popleft()
+
+
+class AsyncService(ServiceCore):
+    def __init__(self, shard=0, reuse_port=False):
+        self.name = self.__class__.__name__
+        self.shard = shard
+
+        self.remote_services = {}
+
+        # Cached methods coalesce concurrent misses with ResultCache.get_async
+        self.rpc_methods = build_dispatch_table(self)
+        self.rpc_permissions = load_permissions()
+
+        self.rpc_slots = None
+        self.rpc_load = RPCLoad()
+        self.rpc_metrics = RPCMetrics()
+        self.rpc_connections = set()
+        # Topic -> connections subscribed to it
+        self.subscribers = dict()
+
+        try:
+            address = get_service_address(ServiceCoord(self.name, shard))
+        except KeyError:
+            raise ConfigError('Address for service %s not found' % self.name)
+
+        if isinstance(address, UnixAddress) and reuse_port:
+            raise ConfigError('Unix socket %s cannot be shared by several workers' % address.path)
+        self.address = address
+        self.reuse_port = reuse_port
+
+        self.rpc_server = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.rpc_slots = asyncio.Semaphore(self.MAX_CONCURRENT_REQUESTS)
+
+        def protocol_factory():
+            return AsyncRPCServiceServer(self)
+
+        if isinstance(self.address, UnixAddress):
+            self.rpc_server = await loop.create_unix_server(
+                protocol_factory, sock=unix_listener(self.address.path, self.LISTEN_BACKLOG))
+        elif self.reuse_port:
+            # Several worker processes share the address, the kernel balances connections between them
+            self.rpc_server = await loop.create_server(
+                protocol_factory, sock=reuse_port_listener(self.address, self.LISTEN_BACKLOG))
+        else:
+            self.rpc_server = await loop.create_server(
+                protocol_factory, self.address.host, self.address.port, backlog=self.LISTEN_BACKLOG)
+
+    async def serve(self):
+        try:
+            await self.start()
+        except OSError as error:
+            print("Error starting service %s: %s" % (self.name, error))
+            return False
+
+        asyncio.get_running_loop().add_signal_handler(signal.SIGINT, self.exit)
+
+        print("Service %s started" % self.name)
+
+        reaper = asyncio.ensure_future(self._drop_silent_clients())
+        heartbeater = asyncio.ensure_future(self._heartbeat_stalled_clients())
+        try:
+            await self.rpc_server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            reaper.cancel()
+            heartbeater.cancel()
+
+        if isinstance(self.address, UnixAddress):
+            try:
+                os.unlink(self.address.path)
+            except OSError:
+                pass
+
+        for connection in list(self.rpc_connections):
+            connection.disconnect()
+        self._disconnect_all()
+        return True
+
+    def run(self):
+        return asyncio.run(self.serve())
+
+    def exit(self):
+        if self.rpc_server is not None:
+            self.rpc_server.close()
+
+    def connect_to(self, coord, on_connect=None, on_disconnect=None, timeout=None):
+        if coord not in self.remote_services:
+            try:
+                service = AsyncRPCServiceClient(coord, auto_retry=0.5, timeout=timeout)
+            except KeyError:
+                raise ConfigError("Missing address and port for %s" % (coord,))
+            service.connect()
+            self.remote_services[coord] = service
+        else:
+            service = self.remote_services[coord]
+
+        if on_connect is not None:
+            service.add_on_connect_handler(on_connect)
+
+        if on_disconnect is not None:
+            service.add_on_disconnect_handler(on_disconnect)
+
+        return service
+
+    async def _drop_silent_clients(self):
+        while True:
+            await asyncio.sleep(self.CLIENT_LIVENESS_TIMEOUT / 3)
+            now = time.monotonic()
+            for connection in list(self.rpc_connections):
+                # A stalled connection is silent because it is not read, not because the client is gone
+                if connection.heartbeats and not connection.stalled and \
+                        now - connection.last_received > self.CLIENT_LIVENESS_TIMEOUT:
+                    print("Client %s:%s stopped sending heartbeats" %
+                          (connection.remote_address.host, connection.remote_address.port))
+                    connection.disconnect()
+
+    async def _heartbeat_stalled_clients(self):
+        # A stalled connection cannot answer the client's heartbeats, the service sends its own instead. Only framed
+        # clients know heartbeats that they did not ask for.
+        while True:
+            await asyncio.sleep(self.STALLED_HEARTBEAT_INTERVAL)
+            for connection in list(self.rpc_connections):
+                if connection.stalled and connection.framed:
+                    connection.send_heartbeat()
+
+    def _disconnect_all(self):
+        for service in self.remote_services.values():
+            if service.connected:
+                service.disconnect()
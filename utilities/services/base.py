@@ -1,45 +1,86 @@
+import os
 import signal
 import socket
+import time
 
 import gevent
+import gevent.pool
+from gevent.pywsgi import WSGIServer
 from gevent.server import StreamServer
 
-from .rpc import rpc_method, RPCServiceServer, RPCServiceClient
-from ..config import get_service_address, ConfigError, ServiceCoord
+from .core import Address, ServiceCore, reuse_port_listener, unix_listener
+from .dispatch import load_permissions
+from .metrics import RPCLoad, RPCMetrics
+from .rpc import build_dispatch_table, RPCServiceServer, RPCServiceClient
+from ..config import get_metrics_address, get_service_address, ConfigError, ServiceCoord, UnixAddress
 
 
-class Address:
-    def __init__(self, host, port):
-        self.host = host
-        self.port = port
-
-
-class Service:
-    def __init__(self, shard=0):
+class Service(ServiceCore):
+    def __init__(self, shard=0, reuse_port=False):
         # gevent.signal_handler(signal.SIGTERM, self.exit)
         gevent.signal_handler(signal.SIGINT, self.exit)
 
         self.name = self.__class__.__name__
+        self.shard = shard
 
         self.remote_services = {}
 
+        self.rpc_methods = build_dispatch_table(self)
+        self.rpc_permissions = load_permissions()
+
+        self.rpc_pool = gevent.pool.Pool(self.MAX_CONCURRENT_REQUESTS)
+        self.rpc_load = RPCLoad()
+        self.rpc_metrics = RPCMetrics()
+        self.rpc_connections = set()
+        # Topic -> connections subscribed to it
+        self.subscribers = dict()
+
         try:
             address = get_service_address(ServiceCoord(self.name, shard))
         except KeyError:
             raise ConfigError('Address for service %s not found' % self.name)
 
-        self.rpc_server = StreamServer(address, self._connection_handler)
+        self.address = address
+        if isinstance(address, UnixAddress):
+            if reuse_port:
+                raise ConfigError('Unix socket %s cannot be shared by several workers' % address.path)
+            self.rpc_server = StreamServer(unix_listener(address.path, self.LISTEN_BACKLOG), self._connection_handler)
+        elif reuse_port:
+            # Several worker processes share the address, the kernel balances connections between them
+            self.rpc_server = StreamServer(reuse_port_listener(address, self.LISTEN_BACKLOG),
+                                           self._connection_handler)
+        else:
+            self.rpc_server = StreamServer(address, self._connection_handler)
+
+        # Optional plain-text metrics endpoint, enabled by a "metrics" entry in the config
+        self.metrics_server = None
+        metrics_address = get_metrics_address(ServiceCoord(self.name, shard))
+        if metrics_address is not None:
+            if reuse_port:
+                # Shared like the service's own address, each scrape is answered by one of the workers
+                listener = reuse_port_listener(metrics_address, self.LISTEN_BACKLOG)
+            else:
+                listener = tuple(metrics_address)
+            self.metrics_server = WSGIServer(listener, self._metrics_handler, log=None)
 
     def _connection_handler(self, sock, addr):
-        print("Client connected: %s:%s" % (addr[0], addr[1]))
-        address = Address(addr[0], addr[1])
+        if isinstance(addr, tuple):
+            address = Address(addr[0], addr[1])
+        else:
+            # Peers of a unix socket have no address, the socket file's permissions restrict who can connect
+            address = Address('unix', 0)
+        print("Client connected: %s:%s" % (address.host, address.port))
         remote_service = RPCServiceServer(self, address)
-        remote_service.handle(sock)
+        self.rpc_connections.add(remote_service)
+        try:
+            remote_service.handle(sock)
+        finally:
+            self.rpc_connections.discard(remote_service)
 
-    def connect_to(self, coord, on_connect=None, on_disconnect=None):
+    def connect_to(self, coord, on_connect=None, on_disconnect=None, timeout=None):
         if coord not in self.remote_services:
             try:
-                service = RPCServiceClient(coord, auto_retry=0.5)
+                service = RPCServiceClient(coord, auto_retry=0.5, timeout=timeout)
             except KeyError:
                 raise ConfigError("Missing address and port for %s" % (coord,))
             service.connect()
@@ -56,11 +97,15 @@ class Service:
         return service
 
     def exit(self):
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
         self.rpc_server.stop()
 
     def run(self):
         try:
             self.rpc_server.start()
+            if self.metrics_server is not None:
+                self.metrics_server.start()
         except socket.gaierror as error:
             print("Error starting service %s: %s" % (self.name, error))
             return False
@@ -70,16 +115,48 @@ class Service:
 
         print("Service %s started" % self.name)
 
+        reaper = gevent.spawn(self._drop_silent_clients)
+        heartbeater = gevent.spawn(self._heartbeat_stalled_clients)
         self.rpc_server.serve_forever()
+        reaper.kill()
+        heartbeater.kill()
+
+        if isinstance(self.address, UnixAddress):
+            try:
+                os.unlink(self.address.path)
+            except OSError:
+                pass
 
         self._disconnect_all()
         return True
 
+    def _drop_silent_clients(self):
+        while True:
+            gevent.sleep(self.CLIENT_LIVENESS_TIMEOUT / 3)
+            now = time.monotonic()
+            for connection in list(self.rpc_connections):
+                # A stalled connection is silent because it is not read, not because the client is gone
+                if connection.heartbeats and not connection.stalled and \
+                        now - connection.last_received > self.CLIENT_LIVENESS_TIMEOUT:
+                    print("Client %s:%s stopped sending heartbeats" %
+                          (connection.remote_address.host, connection.remote_address.port))
+                    connection.disconnect()
+
+    def _heartbeat_stalled_clients(self):
+        # A stalled connection cannot answer the client's heartbeats, the service sends its own instead. Only framed
+        # clients know heartbeats that they did not ask for.
+        while True:
+            gevent.sleep(self.STALLED_HEARTBEAT_INTERVAL)
+            for connection in list(self.rpc_connections):
+                if connection.stalled and connection.framed:
+                    connection.send_heartbeat()
+
     def _disconnect_all(self):
         for service in self.remote_services.values():
             if service.connected:
                 service.disconnect()
 
-    @rpc_method
-    def ping(self, string="ping"):
-        return string
+    def _metrics_handler(self, environ, start_response):
+        body = self.metrics_text().encode('utf-8')
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4'), ('Content-Length', str(len(body)))])
+        return [body]
@@ -0,0 +1,107 @@
+import json
+
+import gevent
+import gevent.event
+
+from utilities.services.status import StatusRegistry
+
+USER_FIELDS = ('username', 'ip_address') + StatusRegistry.FIELDS
+
+
+def user_rows(statuses, directory, changed=None):
+    # One list per user in USER_FIELDS order, only the users in `changed` if given
+    return [[user.username, user.ip_address, *statuses.row(user.id)] for user in directory.entries()
+            if changed is None or user.id in changed]
+
+
+class StatusSubscriber:
+    __slots__ = ('pending', 'overflowed', 'ready')
+
+    def __init__(self):
+        # Users changed since the client was last written to. A dict keeps them in order and only once, so a user
+        # that changes several times in between is sent once, with its latest status.
+        self.pending = dict()
+        # Set when more users changed than the buffer holds, the client gets a full snapshot instead
+        self.overflowed = False
+        self.ready = gevent.event.Event()
+
+
+class StatusBroadcaster:
+    # Pushes status changes of the StatusRegistry to Server-Sent Events clients
+    def __init__(self, statuses, directory, max_pending=1024, coalesce=0.2, keepalive=15):
+        self.statuses = statuses
+        self.directory = directory
+        self.max_pending = max_pending
+        # Seconds to wait after a change before writing, so that a burst (e.g. a ping sweep) goes out as one chunk
+        self.coalesce = coalesce
+        self.keepalive = keepalive
+
+        self.subscribers = set()
+        self.events_sent = 0
+        self.snapshots_sent = 0
+
+        statuses.listeners.append(self.notify)
+
+    def notify(self, id_):
+        for subscriber in self.subscribers:
+            if subscriber.overflowed:
+                continue
+            if len(subscriber.pending) >= self.max_pending and id_ not in subscriber.pending:
+                subscriber.overflowed = True
+                subscriber.pending.clear()
+            else:
+                subscriber.pending[id_] = None
+            subscriber.ready.set()
+
+    def _snapshot(self, changed=None):
+        self.snapshots_sent += 1
+        data = {'fields': USER_FIELDS, 'users': user_rows(self.statuses, self.directory, changed)}
+        return 'id: %d\nevent: snapshot\ndata: %s\n\n' % (
+            self.statuses.version, json.dumps(data, separators=(',', ':')))
+
+    def _events(self, ids):
+        events = []
+        for id_ in ids:
+            user = self.directory.by_id(id_)
+            if user is None:
+                continue
+            data = dict(zip(USER_FIELDS, [user.username, user.ip_address, *self.statuses.row(id_)]))
+            events.append('event: status\ndata: %s\n\n' % json.dumps(data, separators=(',', ':')))
+        self.events_sent += len(events)
+        # The id of the last event is what the client resumes from with Last-Event-ID
+        events.append('id: %d\n\n' % self.statuses.version)
+        return ''.join(events)
+
+    def stream(self, last_event_id=None):
+        # Generator of the SSE body. A client that reconnects with Last-Event-ID only gets what it missed.
+        subscriber = StatusSubscriber()
+        self.subscribers.add(subscriber)
+        try:
+            yield 'retry: 2000\n\n'
+            if last_event_id is not None and last_event_id <= self.statuses.version:
+                yield self._snapshot(self.statuses.changed_since(last_event_id))
+            else:
+                yield self._snapshot()
+
+            while True:
+                if not subscriber.ready.wait(self.keepalive):
+                    yield ': keepalive\n\n'
+                    continue
+                gevent.sleep(self.coalesce)
+                subscriber.ready.clear()
+
+                if subscriber.overflowed:
+                    subscriber.overflowed = False
+                    yield self._snapshot()
+                else:
+                    ids, subscriber.pending = list(subscriber.pending), dict()
+                    yield self._events(ids)
+        finally:
+            self.subscribers.discard(subscriber)
+
+    def as_dict(self):
+        return {
+            'clients': len(self.subscribers),
+            'events_sent': self.events_sent,
+            'snapshots_sent': self.snapshots_sent,
+        }
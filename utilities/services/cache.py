@@ -0,0 +1,149 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+
+
+class TTL:
+    __slots__ = ('seconds',)
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+def make_key(values):
+    # values is the full parameter mapping (defaults included) or a positional list
+    items = tuple(sorted(values.items())) if isinstance(values, dict) else tuple(values)
+    try:
+        hash(items)
+    except TypeError:
+        return json.dumps(values, sort_keys=True, default=repr)
+    return items
+
+
+class ResultCache:
+    def __init__(self, ttl, maxsize, result_factory=None, spawn=None):
+        self.ttl = ttl.seconds if isinstance(ttl, TTL) else ttl
+        self.maxsize = maxsize
+        # Creates the result concurrent misses wait on in get(), e.g. gevent.event.AsyncResult
+        self.result_factory = result_factory
+        # Runs the computation of a miss apart from the callers in get(), e.g. gevent.spawn
+        self.spawn = spawn
+
+        # key -> (expiry, value), least recently used first
+        self._entries = OrderedDict()
+        # key -> AsyncResult (Task in get_async) of the computation, shared by concurrent misses
+        self._computing = dict()
+        # Running get_async computations, the loop only keeps weak references to tasks
+        self._tasks = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] is None or entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            del self._entries[key]
+        return False, None
+
+    def _finish(self, key, computing):
+        # An invalidation while computing already dropped the entry, the value may be stale so keep it out
+        stored = self._computing.get(key) is computing
+        if stored:
+            del self._computing[key]
+        return stored
+
+    def get(self, key, compute):
+        found, value = self._lookup(key)
+        if found:
+            return value
+
+        computing = self._computing.get(key)
+        if computing is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            computing = self._computing[key] = self.result_factory()
+            self.spawn(self._compute, key, computing, compute)
+        # Every caller, the first one included, only waits here under its own deadline. A caller that gives up or
+        # is killed leaves the computation to the others.
+        return computing.get()
+
+    def _compute(self, key, computing, compute):
+        try:
+            value = compute()
+        except BaseException as error:
+            self._finish(key, computing)
+            computing.set_exception(error)
+            return
+
+        if self._finish(key, computing):
+            self._store(key, value)
+        computing.set(value)
+
+    async def get_async(self, key, compute):
+        # Same as get() for coroutine functions, the computation is a task of its own
+        found, value = self._lookup(key)
+        if found:
+            return value
+
+        computing = self._computing.get(key)
+        if computing is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            computing = asyncio.ensure_future(self._compute_async(key, compute))
+            self._computing[key] = computing
+            self._tasks.add(computing)
+            computing.add_done_callback(self._task_done)
+        return await asyncio.shield(computing)
+
+    async def _compute_async(self, key, compute):
+        computing = asyncio.current_task()
+        try:
+            value = await compute()
+        except BaseException:
+            self._finish(key, computing)
+            raise
+
+        if self._finish(key, computing):
+            self._store(key, value)
+        return value
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        # Nobody may be waiting any more, do not let the loop report an unretrieved exception
+        if not task.cancelled():
+            task.exception()
+
+    def _store(self, key, value):
+        expiry = None if self.ttl is None else time.monotonic() + self.ttl
+        self._entries[key] = (expiry, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._entries.clear()
+            self._computing.clear()
+        else:
+            self._entries.pop(key, None)
+            self._computing.pop(key, None)
+
+    def as_dict(self):
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,102 @@
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Every frame is a 4 byte big-endian payload length followed by the payload itself
+FRAME_HEADER = struct.Struct('>I')
+
+# Legacy peers exchange one JSON document per line, terminated by this delimiter
+LINE_DELIMITER = b'\r\n'
+
+# Name of the pseudo-method used to negotiate the framed protocol. It is sent as a regular
+# line-JSON request, so a legacy server answers "Method not found" and both ends stay in line mode.
+HELLO = '__hello'
+
+# Generator methods stream their results to framed peers in chunks of up to STREAM_CHUNK_ITEMS items. The server
+# keeps at most STREAM_WINDOW chunks in flight and the client returns credits as it consumes them.
+STREAM_CHUNK_ITEMS = 64
+STREAM_WINDOW = 8
+
+
+class CodecError(ValueError):
+    pass
+
+
+class JSONCodec:
+    name = 'json'
+
+    @staticmethod
+    def dumps(obj):
+        try:
+            return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+        except (TypeError, ValueError, OverflowError) as error:
+            raise CodecError(error)
+
+    @staticmethod
+    def loads(data):
+        try:
+            return json.loads(data.decode('utf-8'))
+        except (UnicodeDecodeError, ValueError) as error:
+            raise CodecError(error)
+
+
+class MsgpackCodec:
+    name = 'msgpack'
+
+    @staticmethod
+    def dumps(obj):
+        try:
+            return msgpack.packb(obj, use_bin_type=True)
+        except (TypeError, ValueError, OverflowError) as error:
+            raise CodecError(error)
+
+    @staticmethod
+    def loads(data):
+        try:
+            return msgpack.unpackb(data, raw=False, strict_map_key=False)
+        except Exception as error:
+            raise CodecError(error)
+
+
+CODECS = {JSONCodec.name: JSONCodec}
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec
+
+# Codecs offered by clients during negotiation, most preferred first
+PREFERRED_CODECS = [name for name in (MsgpackCodec.name, JSONCodec.name) if name in CODECS]
+
+
+def choose_codec(offered):
+    if not isinstance(offered, (list, tuple)):
+        return None
+    for name in offered:
+        if isinstance(name, str) and name in CODECS:
+            return CODECS[name]
+    return None
+
+
+def hello_request(codecs):
+    return {'__id': HELLO, '__method': HELLO, '__params': {'codecs': list(codecs)}}
+
+
+def hello_response(codec):
+    return {'__id': HELLO, '__data': {'codec': codec.name}, '__error': None}
+
+
+def is_hello(message):
+    return isinstance(message, dict) and message.get('__method') == HELLO
+
+
+def negotiated_codec(response):
+    # Returns the codec picked by the server, or None if the peer only speaks line-JSON
+    if not isinstance(response, dict) or response.get('__id') != HELLO or response.get('__error') is not None:
+        return None
+    data = response.get('__data')
+    if not isinstance(data, dict):
+        return None
+    return CODECS.get(data.get('codec'))
@@ -0,0 +1,70 @@
+import hashlib
+import os
+import time
+from collections import namedtuple
+
+
+class ConfigFile(namedtuple('ConfigFile', ['data', 'etag', 'mimetype', 'filename', 'mtime_ns', 'size'])):
+    pass
+
+
+class ConfigCache:
+    # VPN configurations of the users, kept in memory and served from there. A file is stat'ed at most every
+    # `revalidate` seconds and read again only when its mtime or size changed.
+    ARTIFACTS = (('.conf', 'text/plain'), ('.zip', 'application/zip'))  # WireGuard, tinc
+
+    def __init__(self, directory, revalidate=1.0):
+        self.directory = directory
+        self.revalidate = revalidate
+
+        # name -> (ConfigFile or None, checked at)
+        self._entries = dict()
+
+        self.hits = 0
+        self.loads = 0
+
+    def _find(self, name):
+        for extension, mimetype in self.ARTIFACTS:
+            path = os.path.join(self.directory, name + extension)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            return path, mimetype, stat
+        return None
+
+    def get(self, name):
+        now = time.monotonic()
+        entry = self._entries.get(name)
+        if entry is not None and now - entry[1] < self.revalidate:
+            self.hits += 1
+            return entry[0]
+
+        found = self._find(name)
+        if found is None:
+            self._entries[name] = (None, now)
+            return None
+
+        path, mimetype, stat = found
+        config = None if entry is None else entry[0]
+        if config is None or config.filename != os.path.basename(path) or config.mtime_ns != stat.st_mtime_ns or \
+                config.size != stat.st_size:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Strong ETag, derived from the content itself
+            etag = hashlib.blake2b(data, digest_size=16).hexdigest()
+            config = ConfigFile(data, etag, mimetype, os.path.basename(path), stat.st_mtime_ns, stat.st_size)
+            self.loads += 1
+        else:
+            self.hits += 1
+
+        self._entries[name] = (config, now)
+        return config
+
+    def as_dict(self):
+        return {
+            'files': sum(1 for config, _checked in self._entries.values() if config is not None),
+            'bytes': sum(config.size for config, _checked in self._entries.values() if config is not None),
+            'hits': self.hits,
+            'loads': self.loads,
+        }
@@ -0,0 +1,145 @@
+import os
+import socket
+
+from .dispatch import rpc_method, resolve_permission
+from .metrics import format_labels
+from ..config import ConfigError
+
+
+class RPCError(Exception):
+    pass
+
+
+class RPCTimeout(RPCError):
+    pass
+
+
+class RPCStreamCancelled(RPCError):
+    pass
+
+
+class Address:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+
+def unix_listener(path, backlog):
+    if os.path.exists(path):
+        # Only remove the socket file if nothing is listening on it any more
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+        else:
+            raise ConfigError('Unix socket %s is already in use' % path)
+        finally:
+            probe.close()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(backlog)
+    return sock
+
+
+def reuse_port_listener(address, backlog):
+    family, type_, proto, _canonname, sockaddr = socket.getaddrinfo(
+        address.host, address.port, type=socket.SOCK_STREAM)[0]
+    sock = socket.socket(family, type_, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(sockaddr)
+    sock.listen(backlog)
+    return sock
+
+
+class ServiceCore:
+    # Shared by the gevent Service and the asyncio AsyncService, the subclass sets up the attributes used here
+    MAX_CONCURRENT_REQUESTS = 256  # Requests processed at once by the whole service
+    MAX_CONNECTION_CONCURRENCY = 32  # Requests processed at once for a single connection
+    MAX_CONNECTION_QUEUE = 128  # Requests buffered per connection before it stops being read
+    STREAM_IDLE_TIMEOUT = 60  # Seconds a stream waits for credits before it is cancelled
+    MAX_SUBSCRIBER_BUFFER = 1024  # Published events buffered per subscriber before the oldest are dropped
+    CLIENT_LIVENESS_TIMEOUT = 30  # Seconds of silence after which a client that sends heartbeats is dropped
+    STALLED_HEARTBEAT_INTERVAL = 2  # Seconds between the heartbeats sent on a connection that is not being read
+
+    LISTEN_BACKLOG = 1024
+
+    def get_permission(self, address):
+        return resolve_permission(self.rpc_permissions, address.host)
+
+    def subscribe(self, connection, topics):
+        for topic in topics:
+            self.subscribers.setdefault(topic, set()).add(connection)
+
+    def unsubscribe(self, connection, topics):
+        for topic in topics:
+            connections = self.subscribers.get(topic)
+            if connections is not None:
+                connections.discard(connection)
+                if not connections:
+                    del self.subscribers[topic]
+
+    def publish(self, topic, data):
+        connections = self.subscribers.get(topic)
+        if not connections:
+            return 0
+
+        # Encoded once per codec in use, not once per subscriber
+        encoded = dict()
+        for connection in list(connections):
+            codec = connection.codec
+            if codec.name not in encoded:
+                encoded[codec.name] = codec.dumps({'__event': topic, '__data': data})
+            connection.push_event(encoded[codec.name])
+        return len(connections)
+
+    def invalidate(self, method_name, **params):
+        # Drops the cached result of method_name for params, or every cached result of it when no params are given
+        method = self.rpc_methods[method_name]
+        if method.cache is None:
+            return
+        method.cache.invalidate(method.cache_key(params) if params else None)
+
+    @rpc_method
+    def ping(self, string="ping"):
+        return string
+
+    @rpc_method(permission='service')
+    def load(self):
+        return {
+            'service': self.rpc_load.as_dict(),
+            'connections': {"%s:%s" % (connection.remote_address.host, connection.remote_address.port):
+                            connection.load.as_dict()
+                            for connection in self.rpc_connections},
+        }
+
+    @rpc_method(permission='service')
+    def stats(self):
+        return {
+            'load': self.load(),
+            'methods': self.rpc_metrics.as_dict(),
+            'caches': {name: method.cache.as_dict() for name, method in self.rpc_methods.items()
+                       if method.cache is not None},
+            'clients': {repr(coord): dict(service.connection_stats(), methods=service.metrics.as_dict())
+                        for coord, service in self.remote_services.items()},
+        }
+
+    def metrics_text(self):
+        labels = {'service': self.name, 'shard': self.shard}
+
+        lines = []
+        for name, value in self.rpc_load.as_dict().items():
+            lines.append('rpc_server_%s{%s} %d' % (name, format_labels(labels), value))
+        lines.extend(self.rpc_metrics.render('rpc_server', labels))
+        for coord, service in self.remote_services.items():
+            client_labels = dict(labels, remote=repr(coord))
+            lines.append('rpc_client_connected{%s} %d' % (format_labels(client_labels), service.connected))
+            lines.append('rpc_client_heartbeat_timeouts_total{%s} %d' %
+                         (format_labels(client_labels), service.heartbeat_timeouts))
+            for state, count in service.state_transitions.items():
+                lines.append('rpc_client_state_transitions_total{%s} %d' %
+                             (format_labels(dict(client_labels, state=state)), count))
+            lines.extend(service.metrics.render('rpc_client', client_labels))
+        return '\n'.join(lines) + '\n'
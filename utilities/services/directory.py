@@ -0,0 +1,98 @@
+from collections import namedtuple
+
+import requests
+from pony.orm import db_session, select
+
+from utilities.config import config
+from utilities.models import User
+
+
+class UserEntry(namedtuple('UserEntry', ['id', 'username', 'ip_address'])):
+    pass
+
+
+class UserDirectory:
+    # Users indexed by IP address and by username, so request handlers find the caller with a dict lookup. Misses
+    # fall back to the database, which picks up users added since the last reload. on_change is called with the ids
+    # of the users loaded or added.
+    def __init__(self, on_change=None):
+        self._by_id = dict()
+        self._by_ip = dict()
+        self._by_username = dict()
+        self.on_change = on_change
+
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def load(self):
+        with db_session:
+            entries = [UserEntry(*row) for row in select((u.id, u.username, u.ip_address) for u in User)[:]]
+        # Swapped at once, readers never see a half built index
+        self._by_id = {entry.id: entry for entry in entries}
+        self._by_ip = {entry.ip_address: entry for entry in entries}
+        self._by_username = {entry.username: entry for entry in entries}
+        self.reloads += 1
+        if self.on_change is not None:
+            self.on_change([entry.id for entry in entries])
+
+    def _add(self, user):
+        entry = UserEntry(user.id, user.username, user.ip_address)
+        self._by_id[entry.id] = entry
+        self._by_ip[entry.ip_address] = entry
+        self._by_username[entry.username] = entry
+        if self.on_change is not None:
+            self.on_change([entry.id])
+        return entry
+
+    def by_id(self, id_):
+        # Only used for users already known, e.g. by status updates, so not counted
+        return self._by_id.get(id_)
+
+    def by_ip(self, ip_address):
+        entry = self._by_ip.get(ip_address)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        with db_session:
+            user = User.get(ip_address=ip_address)
+            return None if user is None else self._add(user)
+
+    def by_username(self, username):
+        entry = self._by_username.get(username)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        with db_session:
+            user = User.get(username=username)
+            return None if user is None else self._add(user)
+
+    def entries(self):
+        return self._by_username.values()
+
+    def addresses(self):
+        return {ip_address: entry.id for ip_address, entry in self._by_ip.items()}
+
+    def as_dict(self):
+        return {
+            'users': len(self._by_username),
+            'hits': self.hits,
+            'misses': self.misses,
+            'reloads': self.reloads,
+        }
+
+
+def notify_users_changed():
+    # Called by scripts that change users, so the UserService reloads its directory. It may not be running.
+    host, port = config['api']
+    try:
+        response = requests.post(f'http://{host}:{port}/user_directory', timeout=5)
+        response.raise_for_status()
+    except requests.RequestException as error:
+        print("Could not reload the UserService user directory: %s" % error)
+        return False
+    return True
@@ -0,0 +1,133 @@
+import functools
+import inspect
+import ipaddress
+import socket
+import types
+
+from .cache import ResultCache, make_key
+from ..config import config, ConfigError
+
+
+# Permission levels in increasing order of trust. A connection may call every method whose level is at most its own.
+PERMISSION_LEVELS = {None: 0, 'user': 1, 'service': 2, 'admin': 3}
+
+
+def rpc_method(method=None, permission=None, cache=None, maxsize=1024):
+    # cache=TTL(seconds) memoizes results per parameters, see RPCMethod and Service.invalidate
+    if method is None:
+        return functools.partial(rpc_method, permission=permission, cache=cache, maxsize=maxsize)
+
+    if permission not in PERMISSION_LEVELS:
+        raise ValueError('Unknown permission %r for RPC method %s' % (permission, method.__name__))
+    if cache is not None and (inspect.isgeneratorfunction(method) or inspect.isasyncgenfunction(method)):
+        raise TypeError('Streaming RPC method %s cannot be cached' % method.__name__)
+
+    method.rpc = True
+    method.permission = permission
+    method.cache = cache
+    method.cache_maxsize = maxsize
+    return method
+
+
+class RPCMethod:
+    __slots__ = ('name', 'function', 'level', 'names', 'required', 'defaults', 'var_keyword', 'cache')
+
+    def __init__(self, name, function, result_factory=None, spawn=None):
+        self.name = name
+        self.function = function
+        self.level = PERMISSION_LEVELS[function.permission]
+
+        # Parameters are sent by name, so only keyword-compatible signatures can be served
+        self.names = set()
+        self.required = set()
+        self.defaults = dict()
+        self.var_keyword = False
+        for parameter in inspect.signature(function).parameters.values():
+            if parameter.kind == parameter.VAR_KEYWORD:
+                self.var_keyword = True
+            elif parameter.kind == parameter.POSITIONAL_ONLY:
+                raise TypeError('RPC method %s has positional-only parameter %s' % (name, parameter.name))
+            elif parameter.kind != parameter.VAR_POSITIONAL:
+                self.names.add(parameter.name)
+                if parameter.default is parameter.empty:
+                    self.required.add(parameter.name)
+                else:
+                    self.defaults[parameter.name] = parameter.default
+        self.names = frozenset(self.names)
+        self.required = frozenset(self.required)
+
+        cache = getattr(function, 'cache', None)
+        self.cache = None if cache is None else ResultCache(cache, function.cache_maxsize, result_factory, spawn)
+
+    def cache_key(self, params):
+        # Defaults are filled in, so a call that omits a parameter shares its entry with one that passes the default
+        if isinstance(params, dict):
+            values = dict(self.defaults)
+            values.update(params)
+            return make_key(values)
+        return make_key(params)
+
+    def accepts(self, params):
+        if isinstance(params, dict):
+            keys = params.keys()
+            return self.required <= keys and (self.var_keyword or keys <= self.names)
+        # Positional parameters, as sent by older clients
+        return isinstance(params, list) and len(params) >= len(self.required)
+
+    def __call__(self, params):
+        if self.cache is not None:
+            return self.cache.get(self.cache_key(params), functools.partial(self.call, params))
+        return self.call(params)
+
+    def call(self, params):
+        if isinstance(params, dict):
+            return self.function(**params)
+        return self.function(*params)
+
+
+def build_dispatch_table(service, result_factory=None, spawn=None):
+    methods = dict()
+    for name in dir(type(service)):
+        function = getattr(type(service), name, None)
+        if callable(function) and getattr(function, 'rpc', False):
+            methods[name] = RPCMethod(name, getattr(service, name), result_factory, spawn)
+    return types.MappingProxyType(methods)
+
+
+def load_permissions():
+    # Hosts running other services are trusted as services, local connections as admins (see resolve_permission).
+    # "rpc_permissions" in the config overrides the permission of any host.
+    permissions = dict()
+    for addresses in config['services'].values():
+        for address in addresses:
+            if isinstance(address, str):
+                continue
+            host = address[0]
+            try:
+                host = socket.gethostbyname(host)
+                if ipaddress.ip_address(host).is_loopback:
+                    continue
+            except (OSError, ValueError):
+                pass
+            permissions[host] = 'service'
+
+    for host, permission in config.get('rpc_permissions', {}).items():
+        if permission not in PERMISSION_LEVELS:
+            raise ConfigError('Unknown permission %r for host %s' % (permission, host))
+        permissions[host] = permission
+
+    return permissions
+
+
+def resolve_permission(permissions, host):
+    if host in permissions:
+        return permissions[host]
+    # Peers of a unix socket, whose file permissions restrict who can connect
+    if host == 'unix':
+        return 'admin'
+    try:
+        if ipaddress.ip_address(host).is_loopback:
+            return 'admin'
+    except ValueError:
+        pass
+    return 'user'
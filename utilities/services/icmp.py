@@ -0,0 +1,241 @@
+import collections
+import heapq
+import itertools
+import os
+import socket
+import struct
+import time
+
+from .metrics import Histogram
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+ICMP_HEADER = struct.Struct('!BBHHH')  # type, code, checksum, identifier, sequence
+
+
+def checksum(data):
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+class Pinger:
+    # Pings many IPv4 hosts at once from a single ICMP socket. Every echo request of a sweep is sent up front and
+    # replies are matched back by identifier and sequence number, so a sweep takes about one timeout however many
+    # hosts are down.
+    PAYLOAD = b'vnoi-utilities-ping'.ljust(56, b'\x00')
+
+    def __init__(self, timeout=4.0):
+        self.timeout = timeout
+        self.identifier = os.getpid() & 0xFFFF
+        self._sequence = itertools.count()
+        self._socket = None
+        self._raw = False
+
+    def _open(self):
+        if self._socket is not None:
+            return self._socket
+
+        try:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            self._raw = True
+        except PermissionError:
+            # Unprivileged ping sockets (net.ipv4.ping_group_range), the kernel picks the identifier and only
+            # delivers the replies to our own requests
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            self._raw = False
+        return self._socket
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def _packet(self, sequence):
+        header = ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, self.identifier, sequence)
+        return ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, checksum(header + self.PAYLOAD), self.identifier,
+                                sequence) + self.PAYLOAD
+
+    def _parse(self, data):
+        # Returns the sequence number of an echo reply to one of our requests, None for anything else
+        if self._raw:
+            data = data[(data[0] & 0x0F) * 4:]
+        if len(data) < ICMP_HEADER.size:
+            return None
+
+        type_, code, _checksum, identifier, sequence = ICMP_HEADER.unpack_from(data)
+        if type_ != ICMP_ECHO_REPLY or code != 0:
+            return None
+        # A raw socket sees every ICMP packet of the host, including replies to other ping processes
+        if self._raw and identifier != self.identifier:
+            return None
+        return sequence
+
+    def sweep(self, hosts, timeout=None):
+        # Returns {host: round trip in seconds, or None if it did not answer before the deadline}
+        timeout = self.timeout if timeout is None else timeout
+        results = {host: None for host in hosts}
+        if not results:
+            return results
+
+        sock = self._open()
+        deadline = time.monotonic() + timeout
+
+        # sequence -> (host, address, sent at)
+        outstanding = dict()
+        for host in results:
+            try:
+                address = socket.gethostbyname(host)
+            except (OSError, UnicodeError):
+                continue
+
+            sequence = next(self._sequence) & 0xFFFF
+            sock.settimeout(max(0.0, deadline - time.monotonic()))
+            try:
+                sock.sendto(self._packet(sequence), (address, 0))
+            except OSError:
+                continue
+            outstanding[sequence] = (host, address, time.monotonic())
+
+        while outstanding:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            sock.settimeout(remaining)
+            try:
+                data, (address, _port) = sock.recvfrom(2048)
+            except socket.timeout:
+                break
+            except OSError:
+                continue
+            received = time.monotonic()
+
+            sequence = self._parse(data)
+            entry = outstanding.get(sequence)
+            if entry is None or entry[1] != address:
+                continue
+            del outstanding[sequence]
+            results[entry[0]] = received - entry[2]
+
+        return results
+
+
+class HostSchedule:
+    __slots__ = ('due', 'online', 'failures', 'changes')
+
+    FLAP_CHANGES = 3
+
+    def __init__(self, due):
+        self.due = due
+        self.online = None
+        self.failures = 0  # Consecutive sweeps without an answer
+        self.changes = collections.deque(maxlen=self.FLAP_CHANGES)  # When the host last went up or down
+
+
+class PingScheduler:
+    # Keeps the next time each host is due in a heap. Healthy hosts are pinged every interval, hosts that stay offline
+    # back off up to max_interval, and hosts that keep going up and down are probed twice as often. Hosts due within
+    # `slack` of each other are swept together.
+    def __init__(self, interval, max_interval=None, slack=None):
+        self.interval = interval
+        self.max_interval = interval * 12 if max_interval is None else max_interval
+        self.slack = interval / 10 if slack is None else slack
+        # A host flaps when it changed state FLAP_CHANGES times within this many seconds
+        self.flap_window = interval * 10
+
+        self.hosts = dict()
+        # (due, host), entries whose due no longer matches the host's are skipped
+        self._heap = []
+
+        self.sweeps = 0
+        self.lag = Histogram()  # How late sweeps start after their earliest host was due
+        self.duration = Histogram()
+        self.last_sweep = None
+        self._sweep_lag = 0.0
+
+    def update(self, hosts, now=None):
+        # Starts scheduling new hosts right away and forgets removed ones
+        now = time.monotonic() if now is None else now
+        hosts = set(hosts)
+        for host in hosts - self.hosts.keys():
+            self.hosts[host] = HostSchedule(now)
+            heapq.heappush(self._heap, (now, host))
+        for host in self.hosts.keys() - hosts:
+            del self.hosts[host]
+
+        if len(self._heap) > 2 * len(self.hosts) + 64:
+            self._heap = [(schedule.due, host) for host, schedule in self.hosts.items()]
+            heapq.heapify(self._heap)
+
+    def _drop_stale(self):
+        while self._heap:
+            due, host = self._heap[0]
+            schedule = self.hosts.get(host)
+            if schedule is not None and schedule.due == due:
+                return
+            heapq.heappop(self._heap)
+
+    def next_due(self):
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now=None):
+        now = time.monotonic() if now is None else now
+        hosts = []
+        earliest = self.next_due()
+        while earliest is not None and earliest <= now + self.slack:
+            hosts.append(heapq.heappop(self._heap)[1])
+            earliest = self.next_due()
+
+        if hosts:
+            self.sweeps += 1
+            self._sweep_lag = max(0.0, now - self.hosts[hosts[0]].due)
+            self.lag.record(self._sweep_lag)
+        return hosts
+
+    def record(self, results, started, now=None):
+        # results is {host: round trip or None} of a sweep that started at `started`
+        now = time.monotonic() if now is None else now
+        self.duration.record(now - started)
+        self.last_sweep = {'started': started, 'hosts': len(results), 'seconds': now - started,
+                           'lag': self._sweep_lag}
+
+        for host, rtt in results.items():
+            schedule = self.hosts.get(host)
+            if schedule is None:
+                continue
+
+            online = rtt is not None
+            if schedule.online is not None and schedule.online != online:
+                schedule.changes.append(now)
+            schedule.online = online
+            schedule.failures = 0 if online else schedule.failures + 1
+
+            schedule.due = now + self._interval(schedule, now)
+            heapq.heappush(self._heap, (schedule.due, host))
+
+    def _interval(self, schedule, now):
+        changes = schedule.changes
+        if len(changes) == changes.maxlen and now - changes[0] < self.flap_window:
+            return self.interval / 2
+        if schedule.failures > 1:
+            return min(self.max_interval, self.interval * 2 ** (schedule.failures - 1))
+        return self.interval
+
+    def as_dict(self):
+        now = time.monotonic()
+        next_due = self.next_due()
+        return {
+            'hosts': len(self.hosts),
+            'sweeps': self.sweeps,
+            'overdue': sum(1 for schedule in self.hosts.values() if schedule.due < now),
+            'next_due_in': None if next_due is None else next_due - now,
+            'last_sweep': self.last_sweep,
+            'lag': self.lag.as_dict(),
+            'duration': self.duration.as_dict(),
+        }
@@ -0,0 +1,133 @@
+import argparse
+import importlib
+import os
+import signal
+import sys
+import time
+
+from ..config import get_service_address, get_shard_count, ConfigError, ServiceCoord
+
+
+class Worker:
+    __slots__ = ('shard', 'reuse_port', 'pid', 'started', 'failures')
+
+    def __init__(self, shard, reuse_port):
+        self.shard = shard
+        self.reuse_port = reuse_port
+        self.pid = None
+        self.started = 0.0
+        self.failures = 0
+
+
+class Launcher:
+    # A worker that dies sooner than this after starting counts as failing, restarts back off exponentially
+    MIN_UPTIME = 5
+    MAX_RESTART_DELAY = 30
+
+    def __init__(self, service_class, workers=None):
+        self.service_class = service_class
+        self.name = service_class.__name__
+        self.running = False
+
+        shards = get_shard_count(self.name)
+        if shards == 0:
+            raise ConfigError('Address for service %s not found' % self.name)
+
+        # One worker per configured shard, or `workers` workers per shard sharing its port
+        per_shard = 1 if workers is None else workers
+        addresses = [get_service_address(ServiceCoord(self.name, shard)) for shard in range(shards)]
+        self.workers = []
+        for shard, address in enumerate(addresses):
+            reuse_port = per_shard > 1 or addresses.count(address) > 1
+            self.workers.extend(Worker(shard, reuse_port) for _ in range(per_shard))
+
+    def _spawn(self, worker):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                service = self.service_class(shard=worker.shard, reuse_port=worker.reuse_port)
+                code = 0 if service.run() else 1
+            except BaseException as error:
+                print("Worker of %s:%d crashed: %s" % (self.name, worker.shard, error))
+                code = 1
+            os._exit(code)
+
+        worker.pid = pid
+        worker.started = time.monotonic()
+        print("Started worker %d for %s:%d" % (pid, self.name, worker.shard))
+
+    def _restart_delay(self, worker):
+        if time.monotonic() - worker.started >= self.MIN_UPTIME:
+            worker.failures = 0
+            return 0
+        worker.failures += 1
+        return min(self.MAX_RESTART_DELAY, 0.5 * 2 ** (worker.failures - 1))
+
+    def stop(self, *_args):
+        self.running = False
+        for worker in self.workers:
+            if worker.pid is not None:
+                try:
+                    os.kill(worker.pid, signal.SIGINT)
+                except ProcessLookupError:
+                    pass
+
+    def run(self):
+        self.running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for worker in self.workers:
+            self._spawn(worker)
+
+        by_pid = {worker.pid: worker for worker in self.workers}
+        while by_pid:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+
+            worker = by_pid.pop(pid, None)
+            if worker is None:
+                continue
+            worker.pid = None
+            if not self.running:
+                continue
+
+            delay = self._restart_delay(worker)
+            print("Worker %d for %s:%d exited with status %d, restarting in %.1fs" %
+                  (pid, self.name, worker.shard, status, delay))
+            time.sleep(delay)
+            if self.running:
+                self._spawn(worker)
+                by_pid[worker.pid] = worker
+
+
+def main():
+    from gevent import monkey
+    monkey.patch_all()
+
+    parser = argparse.ArgumentParser(description='Run a service with one worker process per shard or per CPU')
+    parser.add_argument('service', help='Service class, as package.module:ClassName')
+    parser.add_argument('--workers', help='Workers per shard sharing its port, "auto" for one per CPU')
+    args = parser.parse_args()
+
+    module_name, _, class_name = args.service.partition(':')
+    service_class = getattr(importlib.import_module(module_name), class_name)
+
+    workers = args.workers
+    if workers == 'auto':
+        workers = os.cpu_count()
+    elif workers is not None:
+        workers = int(workers)
+
+    Launcher(service_class, workers).run()
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+class RPCLoad:
+    __slots__ = ('queued', 'running', 'waiting', 'deferred', 'stalled', 'rejected', 'expired', 'events_sent',
+                 'events_dropped')
+
+    def __init__(self):
+        self.queued = 0  # Requests read from the socket, waiting for a worker
+        self.running = 0  # Requests being processed
+        self.waiting = 0  # Streams waiting for the client to return credits, they do not hold a slot
+        self.deferred = 0  # Requests that could not start right away
+        self.stalled = 0  # Times reading stopped because the queue was full
+        self.rejected = 0  # Queued requests dropped because the connection closed
+        self.expired = 0  # Requests dropped or aborted because their deadline passed
+        self.events_sent = 0  # Published events written to subscribers
+        self.events_dropped = 0  # Published events discarded because a subscriber's buffer was full
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class Histogram:
+    # Fixed log2 buckets of microseconds: bucket i counts values below 2^i us, the last one everything above
+    BUCKETS = 27  # ~67 s
+    PERCENTILES = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999))
+
+    __slots__ = ('counts', 'count', 'total')
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, seconds):
+        index = int(seconds * 1000000).bit_length()
+        if index >= self.BUCKETS:
+            index = self.BUCKETS - 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+
+    @staticmethod
+    def upper_bound(index):
+        return (1 << index) / 1000000
+
+    def percentile(self, fraction):
+        if self.count == 0:
+            return 0.0
+
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.upper_bound(index)
+        return self.upper_bound(self.BUCKETS - 1)
+
+    def as_dict(self):
+        result = {'count': self.count, 'sum': self.total}
+        for name, fraction in self.PERCENTILES:
+            result[name] = self.percentile(fraction)
+        result['buckets'] = {self.upper_bound(index): count for index, count in enumerate(self.counts) if count}
+        return result
+
+
+class MethodStats:
+    __slots__ = ('calls', 'errors', 'in_flight', 'bytes_in', 'bytes_out', 'latency')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency = Histogram()
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'in_flight': self.in_flight,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'latency': self.latency.as_dict(),
+        }
+
+
+class RPCMetrics:
+    COUNTERS = (('calls', 'calls_total'), ('errors', 'errors_total'), ('bytes_in', 'received_bytes_total'),
+                ('bytes_out', 'sent_bytes_total'))
+
+    def __init__(self):
+        self.methods = dict()
+
+    def method(self, name):
+        stats = self.methods.get(name)
+        if stats is None:
+            stats = self.methods[name] = MethodStats()
+        return stats
+
+    def as_dict(self):
+        return {name: stats.as_dict() for name, stats in self.methods.items()}
+
+    def render(self, prefix, labels):
+        # Prometheus text exposition format
+        lines = []
+        for name, stats in sorted(self.methods.items()):
+            method_labels = dict(labels, method=name)
+            label_text = format_labels(method_labels)
+
+            for attribute, metric in self.COUNTERS:
+                lines.append('%s_%s{%s} %d' % (prefix, metric, label_text, getattr(stats, attribute)))
+            lines.append('%s_in_flight{%s} %d' % (prefix, label_text, stats.in_flight))
+
+            cumulative = 0
+            for index, count in enumerate(stats.latency.counts[:-1]):
+                cumulative += count
+                bucket_labels = format_labels(dict(method_labels, le='%g' % Histogram.upper_bound(index)))
+                lines.append('%s_latency_seconds_bucket{%s} %d' % (prefix, bucket_labels, cumulative))
+            bucket_labels = format_labels(dict(method_labels, le='+Inf'))
+            lines.append('%s_latency_seconds_bucket{%s} %d' % (prefix, bucket_labels, stats.latency.count))
+            lines.append('%s_latency_seconds_sum{%s} %f' % (prefix, label_text, stats.latency.total))
+            lines.append('%s_latency_seconds_count{%s} %d' % (prefix, label_text, stats.latency.count))
+        return lines
+
+
+def format_labels(labels):
+    return ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for key, value in labels.items())
+
+
+def percentile(samples, fraction):
+    # Exact percentile of already sorted samples, for benchmarks
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
@@ -0,0 +1,59 @@
+import os
+import time
+
+import gevent.threadpool
+
+from utilities.models.user import check_password
+from utilities.services.metrics import Histogram
+
+
+class VerifierBusy(Exception):
+    pass
+
+
+class PasswordVerifier:
+    # Checks bcrypt hashes on a pool of native threads. bcrypt releases the GIL while hashing, so checks run on
+    # every core while the gevent loop keeps serving other requests. At most max_queue checks wait for a thread,
+    # further ones are refused with VerifierBusy.
+    def __init__(self, size=None, max_queue=1024):
+        self.size = size or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.pool = gevent.threadpool.ThreadPool(self.size)
+
+        self.waiting = 0
+        self.checks = 0
+        self.rejected = 0
+        self.queue_wait = Histogram()  # From the request to a thread picking it up
+        self.hash_time = Histogram()
+
+    def verify(self, stored, password):
+        if self.waiting >= self.max_queue + self.size:
+            self.rejected += 1
+            raise VerifierBusy()
+
+        self.waiting += 1
+        try:
+            queued = time.monotonic()
+            started, result = self.pool.apply(self._check, (stored, password))
+        finally:
+            self.waiting -= 1
+
+        # Recorded here rather than in the worker thread, so histograms are only ever touched from the loop
+        self.checks += 1
+        self.queue_wait.record(started - queued)
+        self.hash_time.record(time.monotonic() - started)
+        return result
+
+    @staticmethod
+    def _check(stored, password):
+        return time.monotonic(), check_password(stored, password)
+
+    def as_dict(self):
+        return {
+            'threads': self.size,
+            'waiting': self.waiting,
+            'checks': self.checks,
+            'rejected': self.rejected,
+            'queue_wait': self.queue_wait.as_dict(),
+            'hash_time': self.hash_time.as_dict(),
+        }
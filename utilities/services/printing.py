@@ -1,12 +1,16 @@
 from gevent import monkey
 monkey.patch_all()
 
-import subprocess
 import os
 
 from flask import Flask
 from werkzeug.utils import secure_filename
 from flask_restful import Api, Resource, request
+from pony.orm import db_session
+
+from utilities.config import config
+from utilities.models import Printing
+from utilities.services.spooler import PrintSpooler, job_status, upload_name
 
 import logging
 log = logging.getLogger('werkzeug')
@@ -18,18 +22,69 @@ api = Api(app)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1000 * 1000
 app.config['UPLOAD_FOLDER'] = os.path.join('data', 'uploads')
 
+CHUNK_SIZE = 64 * 1024
+
+spooler = PrintSpooler(app.config['UPLOAD_FOLDER'], config.get('print_workers', 2))
+
+
+def save_upload(chunks, filename):
+    # Written under a temporary name, synced, then renamed, so a job never points at a partial file
+    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    partial = path + '.part'
+    try:
+        with open(partial, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    os.replace(partial, path)
+    return path
+
+
 @api.resource('/print')
 class Print(Resource):
     def post(self):
-        file = request.files['file']
-        if file.filename == '':
+        # The UserService forwards the contestant's multipart body as is, and names the caller in a header
+        username = request.headers.get('X-Print-User') or request.form.get('username', '')
+        file = request.files.get('file')
+        filename = '' if file is None else secure_filename(file.filename)
+        stream = None if file is None else file.stream
+        if filename == '':
             return {'error': 'No file selected'}, 400
 
-        if file:
-            filename = secure_filename(file.filename)
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            subprocess.Popen(f'lpr -o media=A4 -o prettyprint -o fit-to-page '
-                             f'{os.path.join(app.config["UPLOAD_FOLDER"], filename)}', shell=True)
-            return {'success': True}, 200
-        else:
-            return {'error': 'No file selected'}, 400
+        # The job is created first and its file named after it, so jobs never share a file
+        job_id = spooler.create(username, filename)
+        if job_id is None:
+            return {'error': 'User not found'}, 404
+
+        try:
+            save_upload(iter(lambda: stream.read(CHUNK_SIZE), b''), upload_name(job_id, filename))
+        except Exception as error:
+            spooler.abort(job_id, 'Upload failed: %s' % error)
+            return {'error': 'Upload failed'}, 500
+
+        spooler.submit(job_id)
+        return {'success': True, 'file': filename, 'job': job_id}, 200
+
+
+@api.resource('/print/<int:job_id>')
+class PrintJob(Resource):
+    @db_session
+    def get(self, job_id):
+        job = Printing.get(id=job_id)
+        if job is None:
+            return {'error': 'Job not found'}, 404
+        return job_status(job), 200
+
+
+@app.route('/print/stats')
+def print_stats():
+    return spooler.as_dict()
+
+
+def main():
+    spooler.start()
@@ -0,0 +1,56 @@
+import bisect
+import hashlib
+
+from .rpc import RPCServiceClient
+from ..config import get_shard_count, ConfigError, ServiceCoord
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class RPCServiceRouter:
+    # Spreads calls over the shards of a service by consistent hashing on a key, so that adding a shard
+    # only moves about 1/n of the keys:
+    #
+    #     router = RPCServiceRouter('UserService')
+    #     router.for_key(username).get_user(username=username)
+    #
+    VIRTUAL_NODES = 128
+
+    def __init__(self, service_name, local_service=None, timeout=None):
+        self.service_name = service_name
+        self.local_service = local_service
+        self.timeout = timeout
+        self.clients = dict()
+
+        shards = get_shard_count(service_name)
+        if shards == 0:
+            raise ConfigError("Missing address and port for %s" % service_name)
+
+        ring = sorted((_hash('%s:%d:%d' % (service_name, shard, node)), shard)
+                      for shard in range(shards) for node in range(self.VIRTUAL_NODES))
+        self._points = [point for point, _shard in ring]
+        self._shards = [shard for _point, shard in ring]
+
+    def shard_for(self, key):
+        index = bisect.bisect(self._points, _hash(str(key))) % len(self._points)
+        return ServiceCoord(self.service_name, self._shards[index])
+
+    def for_key(self, key):
+        coord = self.shard_for(key)
+        client = self.clients.get(coord)
+        if client is None:
+            if self.local_service is not None:
+                client = self.local_service.connect_to(coord, timeout=self.timeout)
+            else:
+                client = RPCServiceClient(coord, auto_retry=0.5, timeout=self.timeout)
+                client.connect()
+            self.clients[coord] = client
+        return client
+
+    def disconnect(self):
+        if self.local_service is None:
+            for client in self.clients.values():
+                client.disconnect()
+        self.clients.clear()
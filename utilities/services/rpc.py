@@ -1,29 +1,64 @@
+import collections
 import functools
-import uuid
-import json
+import heapq
+import inspect
+import itertools
+import random
 import socket
+import time
 from weakref import WeakSet
 
 import gevent
 import gevent.socket
 import gevent.lock
 import gevent.event
+import gevent.queue
 
-from ..config import get_service_address
+from .codec import FRAME_HEADER, LINE_DELIMITER, PREFERRED_CODECS, STREAM_CHUNK_ITEMS, STREAM_WINDOW, CodecError, \
+    JSONCodec, choose_codec, hello_request, hello_response, is_hello, negotiated_codec
+from . import dispatch
+from .core import RPCError, RPCTimeout, RPCStreamCancelled  # noqa: F401
+from .dispatch import PERMISSION_LEVELS, rpc_method  # noqa: F401
+from .metrics import RPCLoad, RPCMetrics
+from ..config import get_service_address, UnixAddress
 
 
-class RPCError(Exception):
-    pass
+def build_dispatch_table(service):
+    # Misses of cached methods are computed in a greenlet of their own, concurrent callers wait on an AsyncResult
+    return dispatch.build_dispatch_table(service, gevent.event.AsyncResult, gevent.spawn)
 
 
-def rpc_method(method, permission=None):
-    method.rpc = True
-    method.permission = permission
-    return method
+class PendingRequest:
+    __slots__ = ('method', 'result', 'deadline', 'started', 'stats')
+
+    def __init__(self, method, result, deadline, stats):
+        self.method = method
+        self.result = result
+        self.deadline = deadline
+        self.started = time.monotonic()
+        self.stats = stats
+
+
+class StreamCredit:
+    __slots__ = ('credits', 'cancelled', 'event')
+
+    def __init__(self, credits):
+        self.credits = credits
+        self.cancelled = False
+        self.event = gevent.event.Event()
+
+    def add(self, credits):
+        self.credits += credits
+        self.event.set()
+
+    def cancel(self):
+        self.cancelled = True
+        self.event.set()
 
 
 class RPCServiceBase:
-    MAX_MESSAGE_SIZE = 1024 * 1024  # 1 MB
+    MAX_MESSAGE_SIZE = 1024 * 1024  # 1 MB, line-JSON messages
+    MAX_FRAME_SIZE = 64 * 1024 * 1024  # 64 MB, length-prefixed frames
 
     def __init__(self, remote_address):
         self._local_address = None
@@ -36,6 +71,11 @@ class RPCServiceBase:
         self._socket = None
         self._reader = None
         self._writer = None
+        self.last_received = 0.0
+
+        # Until a peer negotiates the framed protocol, messages are JSON lines
+        self.codec = JSONCodec
+        self.framed = False
 
         self._read_lock = gevent.lock.RLock()
         self._write_lock = gevent.lock.RLock()
@@ -57,27 +97,50 @@ class RPCServiceBase:
         self._socket = sock
         self._reader = sock.makefile('rb')
         self._writer = sock.makefile('wb')
+
+        try:
+            self._negotiate()
+        except OSError:
+            self._socket = None
+            self._reader = None
+            self._writer = None
+            raise
+
+        self.last_received = time.monotonic()
         self._connection_event.set()
 
-        self._local_address = "%s:%d" % self._socket.getsockname()[:2]
+        local_address = self._socket.getsockname()
+        if isinstance(local_address, tuple):
+            self._local_address = "%s:%d" % local_address[:2]
+        else:
+            self._local_address = "unix:%s" % local_address
 
         for handler in self._on_connect_handlers:
             gevent.spawn(handler, plus)
 
+    def _negotiate(self):
+        pass
+
     def finalize(self):
-        if self.connected:
+        if not self.connected:
             return
 
         self._socket = None
         self._reader = None
         self._writer = None
         self._local_address = None
+        self.codec = JSONCodec
+        self.framed = False
         self._connection_event.clear()
 
         for handler in self._on_disconnect_handlers:
             gevent.spawn(handler)
 
     def disconnect(self):
+        return self._close()
+
+    def _close(self):
+        # Drops the connection; unlike RPCServiceClient.disconnect this lets a client reconnect
         if not self.connected:
             return False
 
@@ -99,10 +162,24 @@ class RPCServiceBase:
             with self._read_lock:
                 if not self.connected:
                     raise OSError('Service not connected')
-                data = self._reader.readline(self.MAX_MESSAGE_SIZE)
 
-                if len(data) > 0 and not data.endswith(b'\r\n'):
-                    raise OSError('Message too long')
+                if self.framed:
+                    header = self._reader.read(FRAME_HEADER.size)
+                    if len(header) < FRAME_HEADER.size:
+                        return b""
+
+                    length, = FRAME_HEADER.unpack(header)
+                    if length > self.MAX_FRAME_SIZE:
+                        raise OSError('Message too long')
+
+                    data = self._reader.read(length)
+                    if len(data) < length:
+                        return b""
+                else:
+                    data = self._reader.readline(self.MAX_MESSAGE_SIZE)
+
+                    if len(data) > 0 and not data.endswith(LINE_DELIMITER):
+                        raise OSError('Message too long')
         except OSError as error:
             if self.connected:
                 raise error
@@ -111,34 +188,135 @@ class RPCServiceBase:
 
         return data
 
+    def _frame(self, data):
+        if self.framed:
+            if len(data) > self.MAX_FRAME_SIZE:
+                raise OSError('Message too long')
+            return FRAME_HEADER.pack(len(data)), data
+        else:
+            if len(data) + len(LINE_DELIMITER) > self.MAX_MESSAGE_SIZE:
+                raise OSError('Message too long')
+            return data, LINE_DELIMITER
+
     def _write(self, data):
         if not self.connected:
             raise OSError('Service not connected')
 
-        if len(data + b'\r\n') > self.MAX_MESSAGE_SIZE:
-            raise OSError('Message too long')
+        try:
+            with self._write_lock:
+                if not self.connected:
+                    raise OSError('Service not connected')
+                for part in self._frame(data):
+                    self._writer.write(part)
+                self._writer.flush()
+        except OSError as error:
+            self.finalize()
+            raise error
+
+    def _write_many(self, datas):
+        # Frames several messages and hands them to the socket in a single write
+        if not self.connected:
+            raise OSError('Service not connected')
 
         try:
             with self._write_lock:
                 if not self.connected:
                     raise OSError('Service not connected')
-                self._writer.write(data + b'\r\n')
+                parts = []
+                for data in datas:
+                    parts.extend(self._frame(data))
+                self._writer.write(b''.join(parts))
                 self._writer.flush()
         except OSError as error:
             self.finalize()
             raise error
 
+    def run(self):
+        while True:
+            try:
+                data = self._read()
+            except OSError:
+                self._close()
+                break
+
+            if len(data) == 0:
+                self.finalize()
+                break
+
+            self.last_received = time.monotonic()
+
+            try:
+                message = self.codec.loads(data)
+            except CodecError:
+                self.disconnect()
+                break
+
+            self.process_message(message, len(data))
+
+    def process_message(self, message, size):
+        raise NotImplementedError
+
 
 class RPCServiceServer(RPCServiceBase):
     def __init__(self, local_service, remote_address):
         super().__init__(remote_address)
         self.local_service = local_service
+        self.permission_level = PERMISSION_LEVELS[local_service.get_permission(remote_address)]
 
         self.pending_incoming_requests_threads = WeakSet()
 
+        # Requests are queued here by the reader and started by the dispatcher. When the queue is full the reader
+        # blocks, so the socket is not read any further and TCP flow control pushes back on the client.
+        self.load = RPCLoad()
+        self._queue = gevent.queue.Queue(local_service.MAX_CONNECTION_QUEUE)
+        self._slots = gevent.lock.BoundedSemaphore(local_service.MAX_CONNECTION_CONCURRENCY)
+        # Greenlets of streams that gave their slot back while waiting for credits, see _wait_for_credits
+        self._slotless = set()
+        self._dispatcher = None
+
+        # Responses finished during the same loop iteration are written together by one flusher greenlet
+        self._outbox = []
+        self._flusher = None
+
+        # Credits of the responses currently being streamed, by request id
+        self._streams = dict()
+
+        self.heartbeats = False
+        # Set while the reader waits for room in the queue, the client's heartbeats are not read meanwhile
+        self.stalled = False
+
+        # Encoded events for this subscriber, the oldest are dropped when it does not keep up
+        self.topics = set()
+        self._events = collections.deque(maxlen=local_service.MAX_SUBSCRIBER_BUFFER)
+        self._events_ready = gevent.event.Event()
+        self._pusher = None
+
     def finalize(self):
         super().finalize()
 
+        if self._dispatcher is not None:
+            self._dispatcher.kill(block=False)
+            self._dispatcher = None
+
+        self._outbox = []
+
+        for stream in self._streams.values():
+            stream.cancel()
+        self._streams.clear()
+
+        self.local_service.unsubscribe(self, self.topics)
+        self.topics.clear()
+        self._events.clear()
+        if self._pusher is not None:
+            self._pusher.kill(block=False)
+            self._pusher = None
+
+        dropped = self._queue.qsize()
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._update_load('queued', -dropped)
+        self._update_load('rejected', dropped)
+
         for thread in self.pending_incoming_requests_threads:
             thread.kill(RPCError(), block=False)
 
@@ -146,36 +324,122 @@ class RPCServiceServer(RPCServiceBase):
 
     def handle(self, sock):
         self.initialize(sock, self.remote_address)
+        self._dispatcher = gevent.spawn(self._dispatch)
         self.run()
 
-    def run(self):
+    def _update_load(self, name, delta):
+        setattr(self.load, name, getattr(self.load, name) + delta)
+        service_load = self.local_service.rpc_load
+        setattr(service_load, name, getattr(service_load, name) + delta)
+
+    def _dispatch(self):
+        pool = self.local_service.rpc_pool
         while True:
+            message, received, size = self._queue.get()
             try:
-                data = self._read()
-            except OSError:
-                break
+                self._slots.acquire()
+                # Blocks while every worker of the service is busy
+                pool.spawn(self._process_queued_request, message, received, size)
+            except gevent.GreenletExit:
+                self._update_load('queued', -1)
+                self._update_load('rejected', 1)
+                raise
+
+    def _process_queued_request(self, message, received, size):
+        self._update_load('queued', -1)
+        self._update_load('running', 1)
+        try:
+            self.process_incoming_request(message, received, size)
+        finally:
+            self._update_load('running', -1)
+            current = gevent.getcurrent()
+            if current in self._slotless:
+                self._slotless.discard(current)
+            else:
+                self._slots.release()
 
-            if len(data) == 0:
-                self.finalize()
-                break
+    def process_message(self, message, size):
+        # The hello has to be answered before the next message is read, since it switches the framing
+        if not self.framed and is_hello(message):
+            self.accept_hello(message)
+            return
 
-            gevent.spawn(self.process_data, data)
+        # Control messages are handled by the reader itself. It still blocks while the queue is full, which is why
+        # streams waiting for credits give their slot back (see _wait_for_credits) and the queue keeps draining.
+        if isinstance(message, dict):
+            if '__credit' in message or '__cancel' in message:
+                self.process_stream_control(message)
+                return
+            if '__subscribe' in message or '__unsubscribe' in message:
+                self.process_subscription(message)
+                return
+            if '__heartbeat' in message:
+                # Clients that send heartbeats are dropped by the service once they stop
+                self.heartbeats = True
+                self._send(self.codec.dumps(message))
+                return
+
+        # Batches arrive as a single frame holding a list of requests
+        if isinstance(message, list):
+            for request in message:
+                self._enqueue(request, size // len(message))
+        else:
+            self._enqueue(message, size)
+
+    def _enqueue(self, message, size):
+        if not self._queue.empty() or self._slots.locked() or self.local_service.rpc_pool.full():
+            self._update_load('deferred', 1)
+        self._update_load('queued', 1)
+        if not self._queue.full():
+            self._queue.put((message, time.monotonic(), size))
+            return
 
-    def process_data(self, data):
+        self._update_load('stalled', 1)
+        self.stalled = True
         try:
-            message = json.loads(data.decode('utf-8'))
-        except ValueError:
-            self.disconnect()
-            return
+            self._queue.put((message, time.monotonic(), size))
+        finally:
+            self.stalled = False
+            # Whatever the client sent meanwhile is still unread, the silence was ours
+            self.last_received = time.monotonic()
+
+    def accept_hello(self, request):
+        params = request.get('__params')
+        codec = choose_codec(params.get('codecs') if isinstance(params, dict) else None)
+        if codec is None:
+            response = {'__id': request.get('__id'), '__data': None, '__error': 'No common codec'}
+        else:
+            response = hello_response(codec)
+
+        with self._write_lock:
+            try:
+                self._write(JSONCodec.dumps(response))
+            except OSError:
+                return
 
-        self.process_incoming_request(message)
+            if codec is not None:
+                self.codec = codec
+                self.framed = True
 
-    def process_incoming_request(self, request):
-        if not {'__id', '__method', '__params'}.issubset(request.keys()):
+    def process_incoming_request(self, request, received=None, size=0):
+        if not isinstance(request, dict) or not {'__id', '__method', '__params'}.issubset(request.keys()):
             self.disconnect()
             return
 
         id_ = request['__id']
+        if received is None:
+            received = time.monotonic()
+
+        # The client sends the time it is still willing to wait, which is turned into a local deadline
+        remaining = request.get('__timeout')
+        if isinstance(remaining, (int, float)):
+            remaining -= time.monotonic() - received
+            if remaining <= 0:
+                # Nobody is waiting for this answer any more
+                self._update_load('expired', 1)
+                return
+        else:
+            remaining = None
 
         self.pending_incoming_requests_threads.add(gevent.getcurrent())
 
@@ -185,54 +449,306 @@ class RPCServiceServer(RPCServiceBase):
             '__error': None
         }
 
-        method_name = request['__method']
+        method = self.local_service.rpc_methods.get(request['__method'])
+
+        # Unknown method names are not recorded, so clients cannot grow the metrics without bound
+        stats = None if method is None else self.local_service.rpc_metrics.method(method.name)
+        if stats is not None:
+            stats.calls += 1
+            stats.bytes_in += size
 
-        if not hasattr(self.local_service, method_name):
+        if method is None:
             response['__error'] = 'Method not found'
+        elif method.level > self.permission_level:
+            response['__error'] = 'Permission denied'
+        elif not method.accepts(request['__params']):
+            response['__error'] = 'Invalid parameters'
         else:
-            method = getattr(self.local_service, method_name)
-            if not getattr(method, 'rpc', False):
-                response['__error'] = 'Method not found'
-            else:
-                try:
-                    response['__data'] = method(*request['__params'])
-                except Exception as error:
-                    response['__error'] = "%s: %s\n%s" % (error.__class__.__name__, error, error.__traceback__)
+            stats.in_flight += 1
+            deadline_timer = gevent.Timeout(remaining)
+            try:
+                with deadline_timer:
+                    value = method(request['__params'])
+                    if inspect.isgenerator(value) and not self.framed:
+                        # Line-JSON peers cannot receive streams, they get the whole result at once
+                        value = list(value)
+
+                if inspect.isgenerator(value):
+                    self._stream_response(id_, value, stats)
+                    return
+                response['__data'] = value
+            except gevent.Timeout as error:
+                if error is deadline_timer:
+                    stats.errors += 1
+                    self._update_load('expired', 1)
+                    return
+                response['__error'] = "%s: %s" % (error.__class__.__name__, error)
+            except Exception as error:
+                response['__error'] = "%s: %s\n%s" % (error.__class__.__name__, error, error.__traceback__)
+            finally:
+                stats.in_flight -= 1
+                stats.latency.record(time.monotonic() - received)
 
         try:
-            data = json.dumps(response).encode('utf-8')
-        except (TypeError, ValueError):
+            data = self.codec.dumps(response)
+        except CodecError:
+            if stats is not None:
+                stats.errors += 1
             return
 
+        if stats is not None:
+            stats.bytes_out += len(data)
+            if response['__error'] is not None:
+                stats.errors += 1
+
+        self._send(data)
+
+    def send_heartbeat(self):
+        # Sent by the service while the connection is stalled, so the client does not take it for dead
         try:
-            self._write(data)
+            self._send(self.codec.dumps({'__heartbeat': None}))
+        except CodecError:
+            pass
+
+    def process_stream_control(self, message):
+        stream = self._streams.get(message.get('__id'))
+        if stream is None:
+            return
+
+        if message.get('__cancel'):
+            stream.cancel()
+        elif isinstance(message.get('__credit'), int):
+            stream.add(message['__credit'])
+
+    def process_subscription(self, message):
+        topics = message.get('__subscribe') or message.get('__unsubscribe')
+        if not isinstance(topics, list) or not all(isinstance(topic, str) for topic in topics):
+            return
+
+        if '__subscribe' in message:
+            self.topics.update(topics)
+            self.local_service.subscribe(self, topics)
+        else:
+            self.topics.difference_update(topics)
+            self.local_service.unsubscribe(self, topics)
+
+    def push_event(self, data):
+        if not self.connected:
+            return
+
+        if len(self._events) == self._events.maxlen:
+            self._update_load('events_dropped', 1)
+        self._events.append(data)
+        self._events_ready.set()
+
+        if self._pusher is None:
+            self._pusher = gevent.spawn(self._push_events)
+
+    def _push_events(self):
+        while self.connected:
+            self._events_ready.clear()
+            if not self._events:
+                self._events_ready.wait()
+                continue
+
+            # Events stay in the bounded buffer until the socket takes them, so a slow subscriber only loses the oldest
+            events = list(self._events)
+            self._events.clear()
+            try:
+                self._write_many(events)
+            except OSError:
+                return
+            self._update_load('events_sent', len(events))
+
+    def _stream_response(self, id_, generator, stats):
+        stream = StreamCredit(STREAM_WINDOW)
+        self._streams[id_] = stream
+
+        error = None
+        try:
+            chunk = []
+            for item in generator:
+                chunk.append(item)
+                if len(chunk) >= STREAM_CHUNK_ITEMS:
+                    self._send_stream_chunk(id_, stream, chunk, stats)
+                    chunk = []
+            if chunk:
+                self._send_stream_chunk(id_, stream, chunk, stats)
+        except RPCStreamCancelled:
+            return
+        except Exception as error_:
+            error = "%s: %s" % (error_.__class__.__name__, error_)
+            stats.errors += 1
+        finally:
+            generator.close()
+            self._streams.pop(id_, None)
+
+        data = self.codec.dumps({'__id': id_, '__data': None, '__error': error, '__stream': False})
+        stats.bytes_out += len(data)
+        self._send(data)
+
+    def _send_stream_chunk(self, id_, stream, chunk, stats):
+        if stream.credits <= 0 and not stream.cancelled:
+            self._wait_for_credits(stream)
+        if stream.cancelled:
+            raise RPCStreamCancelled()
+
+        stream.credits -= 1
+        data = self.codec.dumps({'__id': id_, '__data': chunk, '__error': None, '__stream': True})
+        stats.bytes_out += len(data)
+        self._send(data)
+
+    def _wait_for_credits(self, stream):
+        # The slot is given back while waiting: the credits may be read only once queued requests got a slot. A
+        # client that stops reading a stream without closing it gets it cancelled after STREAM_IDLE_TIMEOUT.
+        current = gevent.getcurrent()
+        self._slots.release()
+        self._slotless.add(current)
+        self._update_load('running', -1)
+        self._update_load('waiting', 1)
+        try:
+            timeout = self.local_service.STREAM_IDLE_TIMEOUT
+            deadline = time.monotonic() + timeout
+            while stream.credits <= 0 and not stream.cancelled:
+                stream.event.clear()
+                if not stream.event.wait(max(0.0, deadline - time.monotonic())):
+                    raise RPCTimeout('No credits for %d seconds' % timeout)
+        finally:
+            self._update_load('waiting', -1)
+            self._update_load('running', 1)
+
+        # Left in _slotless if killed while waiting for the slot, so that it is not released twice
+        self._slots.acquire()
+        self._slotless.discard(current)
+
+    def _send(self, data):
+        if not self.connected:
+            return
+
+        self._outbox.append(data)
+        if self._flusher is None:
+            # A spawned greenlet only starts on the next loop iteration, after the current batch of workers ran
+            self._flusher = gevent.spawn(self._flush_outbox)
+
+    def _flush_outbox(self):
+        try:
+            with self._write_lock:
+                outbox, self._outbox = self._outbox, []
+                self._flusher = None
+                if outbox:
+                    self._write_many(outbox)
         except OSError:
             return
 
 
 class RPCServiceClient(RPCServiceBase):
-    def __init__(self, remove_service_cord, auto_retry=None):
+    HANDSHAKE_TIMEOUT = 5
+
+    CONNECTION_STATES = ('disconnected', 'connecting', 'connected', 'backoff')
+
+    def __init__(self, remove_service_cord, auto_retry=None, codecs=None, timeout=None,
+                 heartbeat=2.0, liveness=6.0, max_retry=30.0):
         super().__init__(get_service_address(remove_service_cord))
 
         self.remote_service_cord = remove_service_cord
 
         self.pending_outgoing_requests = dict()
-        self.pending_outgoing_requests_results = dict()
+        self._request_ids = itertools.count(1)
+        # Streams whose first chunk arrived, by request id
+        self._streams = dict()
+
+        # Default deadline in seconds for every call to this service, None waits forever
+        self.timeout = timeout
+        # Heap of (deadline, id) shared by all calls, expired by a single sweeper greenlet
+        self._deadlines = []
+        self._sweeper = None
+        self._sweeper_wakeup = gevent.event.Event()
+
+        self.metrics = RPCMetrics()
 
+        # Handlers of the topics this client subscribed to, subscriptions are renewed on every (re)connection
+        self._subscriptions = dict()
+        self.add_on_connect_handler(self._renew_subscriptions)
+
+        # Reconnection waits a random time up to auto_retry * 2^(attempt - 1), capped at max_retry, so that
+        # clients of a restarted service do not all come back at the same moment
         self.auto_retry = auto_retry
+        self.max_retry = max_retry
+        # Codecs offered to the server, most preferred first. An empty list keeps the legacy line-JSON protocol.
+        self.codecs = PREFERRED_CODECS if codecs is None else codecs
+
+        # A heartbeat is sent every `heartbeat` seconds, the peer is considered dead after `liveness` seconds
+        # without receiving anything. None disables heartbeats.
+        self.heartbeat_interval = heartbeat
+        self.liveness_timeout = liveness
+        self.heartbeat_timeouts = 0
+        self.heartbeat_rtt = None
+        self._heartbeat = None
+
+        self.state = 'disconnected'
+        self.state_transitions = {state: 0 for state in self.CONNECTION_STATES}
+        self._on_state_change_handlers = list()
 
         self._loop = None
 
     def finalize(self):
         super().finalize()
 
-        for result in self.pending_outgoing_requests_results.values():
-            result.set_exception(RPCError())
-
+        pending_requests = list(self.pending_outgoing_requests.values())
         self.pending_outgoing_requests.clear()
-        self.pending_outgoing_requests_results.clear()
+        self._deadlines.clear()
+
+        streams = list(self._streams.values())
+        self._streams.clear()
+
+        for pending in pending_requests:
+            self._complete(pending, error=RPCError())
+
+        for stream in streams:
+            stream.finish(RPCError('Connection lost'))
+
+        if self._heartbeat is not None:
+            self._heartbeat.kill(block=False)
+            self._heartbeat = None
+
+    def _negotiate(self):
+        if not self.codecs:
+            return
+
+        # Runs before the connection is marked as connected, so nothing else can write in between
+        self._socket.settimeout(self.HANDSHAKE_TIMEOUT)
+        try:
+            self._writer.write(JSONCodec.dumps(hello_request(self.codecs)))
+            self._writer.write(LINE_DELIMITER)
+            self._writer.flush()
+            line = self._reader.readline(self.MAX_MESSAGE_SIZE)
+        finally:
+            self._socket.settimeout(None)
+
+        if not line.endswith(LINE_DELIMITER):
+            raise OSError('Handshake failed')
+
+        try:
+            response = JSONCodec.loads(line)
+        except CodecError:
+            raise OSError('Handshake failed')
+
+        codec = negotiated_codec(response)
+        if codec is not None:
+            self.codec = codec
+            self.framed = True
 
     def _connect(self):
+        if isinstance(self.remote_address, UnixAddress):
+            # Co-located services skip name resolution and the TCP stack
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.remote_address.path)
+                self.initialize(sock, self.remote_address)
+            except OSError:
+                sock.close()
+            return
+
         try:
             addresses = gevent.socket.getaddrinfo(
                 self.remote_address.host,
@@ -249,21 +765,81 @@ class RPCServiceClient(RPCServiceBase):
                 sock.connect(sockaddr)
             except OSError:
                 continue
-            else:
+
+            try:
                 self.initialize(sock, self.remote_address)
-                break
+            except OSError:
+                sock.close()
+                continue
+            break
+
+    def add_on_state_change_handler(self, handler):
+        self._on_state_change_handlers.append(handler)
+
+    def _set_state(self, state):
+        previous, self.state = self.state, state
+        self.state_transitions[state] += 1
+        for handler in self._on_state_change_handlers:
+            gevent.spawn(handler, previous, state)
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_retry, self.auto_retry * 2 ** (attempt - 1)))
 
     def _run(self):
+        attempt = 0
         while True:
-            self._connect()
-            while not self.connected and self.auto_retry is not None:
-                gevent.sleep(self.auto_retry)
+            self._set_state('connecting')
+            try:
                 self._connect()
+            except OSError:
+                pass
+
             if self.connected:
+                attempt = 0
+                self._set_state('connected')
+                if self.heartbeat_interval is not None:
+                    self._heartbeat = gevent.spawn(self._send_heartbeats)
                 self.run()
+
+            self._set_state('disconnected')
             if self.auto_retry is None:
                 break
 
+            attempt += 1
+            self._set_state('backoff')
+            gevent.sleep(self._backoff(attempt))
+
+    def _send_heartbeats(self):
+        while self.connected:
+            gevent.sleep(self.heartbeat_interval)
+            if not self.connected:
+                break
+
+            silence = time.monotonic() - self.last_received
+            if silence > self.liveness_timeout:
+                self.heartbeat_timeouts += 1
+                print("No data from %s for %.1fs, reconnecting" % (self.remote_address, silence))
+                self._heartbeat = None
+                self._close()
+                break
+
+            if self.framed:
+                try:
+                    self._write(self.codec.dumps({'__heartbeat': time.monotonic()}))
+                except (CodecError, OSError):
+                    pass
+            else:
+                # Line-JSON servers do not know heartbeats, but every service answers ping
+                self.execute_rpc('ping', {}, timeout=self.liveness_timeout)
+
+    def connection_stats(self):
+        return {
+            'state': self.state,
+            'transitions': dict(self.state_transitions),
+            'heartbeat_timeouts': self.heartbeat_timeouts,
+            'heartbeat_rtt': self.heartbeat_rtt,
+        }
+
     def connect(self):
         if self._loop is not None and not self._loop.ready():
             raise RuntimeError('Service already (re)connecting')
@@ -273,77 +849,244 @@ class RPCServiceClient(RPCServiceBase):
         if super().disconnect():
             self._loop.kill()
             self._loop = None
+            self._set_state('disconnected')
+
+    def process_message(self, message, size):
+        if isinstance(message, dict) and '__event' in message:
+            self.process_event(message)
+        elif isinstance(message, dict) and '__heartbeat' in message:
+            if isinstance(message['__heartbeat'], float):
+                self.heartbeat_rtt = time.monotonic() - message['__heartbeat']
+        elif isinstance(message, list):
+            for response in message:
+                self.process_incoming_response(response, size // len(message))
+        else:
+            self.process_incoming_response(message, size)
+
+    def process_event(self, event):
+        topic = event['__event']
+        for handler in self._subscriptions.get(topic, ()):
+            gevent.spawn(handler, topic, event.get('__data'))
+
+    def subscribe(self, topic, handler):
+        handlers = self._subscriptions.setdefault(topic, [])
+        handlers.append(handler)
+        if len(handlers) == 1 and self.connected:
+            self._send_subscription('__subscribe', [topic])
+
+    def unsubscribe(self, topic, handler=None):
+        handlers = self._subscriptions.get(topic, [])
+        if handler is not None and handler in handlers:
+            handlers.remove(handler)
+        if handler is None or not handlers:
+            self._subscriptions.pop(topic, None)
+            if self.connected:
+                self._send_subscription('__unsubscribe', [topic])
 
-    def run(self):
-        while True:
-            try:
-                data = self._read()
-            except OSError:
-                break
-
-            if len(data) == 0:
-                self.finalize()
-                break
-
-            gevent.spawn(self.process_data, data)
+    def _renew_subscriptions(self, _plus):
+        if self._subscriptions:
+            self._send_subscription('__subscribe', list(self._subscriptions))
 
-    def process_data(self, data):
-        try:
-            message = json.loads(data.decode('utf-8'))
-        except ValueError:
-            self.disconnect()
+    def _send_subscription(self, kind, topics):
+        if not self.framed:
+            print("Cannot subscribe to %s: %s only speaks line-JSON" % (topics, self.remote_address))
             return
+        try:
+            self._write(self.codec.dumps({kind: topics}))
+        except OSError:
+            pass
 
-        self.process_incoming_response(message)
-
-    def process_incoming_response(self, response):
-        if not {'__id', '__data', '__error'}.issubset(response.keys()):
+    def process_incoming_response(self, response, size=0):
+        if not isinstance(response, dict) or not {'__id', '__data', '__error'}.issubset(response.keys()):
             self.disconnect()
             return
 
-        id_ = response['__id']
+        if '__stream' in response:
+            self.process_stream_response(response, size)
+            return
 
-        if id_ not in self.pending_outgoing_requests:
+        pending = self.pending_outgoing_requests.pop(response['__id'], None)
+        if pending is None:
             return
 
-        request = self.pending_outgoing_requests.pop(id_)
-        result = self.pending_outgoing_requests_results.pop(id_)
         error = response['__error']
 
         if error is not None:
-            error_msg = "%s signaled RPC for %s: %s" % (self.remote_address, request['__method'], error)
-            result.set_exception(RPCError(error_msg))
+            error_msg = "%s signaled RPC for %s: %s" % (self.remote_address, pending.method, error)
+            self._complete(pending, size, error=RPCError(error_msg))
+        else:
+            self._complete(pending, size, value=response['__data'])
+
+    def _register(self, id_, pending, size):
+        pending.stats.calls += 1
+        pending.stats.in_flight += 1
+        pending.stats.bytes_out += size
+        self.pending_outgoing_requests[id_] = pending
+
+    def _complete(self, pending, size=0, error=None, value=None):
+        stats = pending.stats
+        stats.in_flight -= 1
+        stats.bytes_in += size
+        stats.latency.record(time.monotonic() - pending.started)
+
+        if error is not None:
+            stats.errors += 1
+            pending.result.set_exception(error)
         else:
-            result.set(response['__data'])
+            pending.result.set(value)
 
-    def execute_rpc(self, method, data):
-        id_ = uuid.uuid4().hex
+    def process_stream_response(self, response, size=0):
+        id_ = response['__id']
+
+        stream = self._streams.get(id_)
+        if stream is None:
+            pending = self.pending_outgoing_requests.pop(id_, None)
+            if pending is None:
+                return
+            # The call resolves to the stream as soon as its first frame arrives, so its deadline no longer applies
+            stream = RPCStream(self, id_, pending.method, pending.stats)
+            self._streams[id_] = stream
+            self._complete(pending, value=stream)
 
+        stream.stats.bytes_in += size
+
+        if response['__stream']:
+            stream.feed(response['__data'])
+        else:
+            del self._streams[id_]
+            error = response['__error']
+            if error is not None:
+                stream.stats.errors += 1
+                error = RPCError("%s signaled RPC for %s: %s" % (self.remote_address, stream.method, error))
+            stream.finish(error)
+
+    def _send_stream_control(self, id_, **control):
+        if id_ not in self._streams:
+            return
+        control = {'__' + key: value for key, value in control.items()}
+        control['__id'] = id_
+        try:
+            self._write(self.codec.dumps(control))
+        except OSError:
+            pass
+
+    def _add_deadline(self, deadline, id_):
+        heapq.heappush(self._deadlines, (deadline, id_))
+
+        # Entries of answered requests are left in the heap, drop them once they dominate it
+        if len(self._deadlines) > 2 * len(self.pending_outgoing_requests) + 64:
+            self._deadlines = [(deadline_, id__) for deadline_, id__ in self._deadlines
+                               if id__ in self.pending_outgoing_requests]
+            heapq.heapify(self._deadlines)
+
+        if self._sweeper is None:
+            self._sweeper = gevent.spawn(self._sweep)
+        elif self._deadlines[0][1] == id_:
+            self._sweeper_wakeup.set()
+
+    def _sweep(self):
+        while True:
+            now = time.monotonic()
+            while self._deadlines and self._deadlines[0][0] <= now:
+                deadline, id_ = heapq.heappop(self._deadlines)
+                pending = self.pending_outgoing_requests.get(id_)
+                if pending is not None and pending.deadline == deadline:
+                    del self.pending_outgoing_requests[id_]
+                    self._complete(pending, error=RPCTimeout(
+                        "%s timed out RPC for %s" % (self.remote_address, pending.method)))
+
+            self._sweeper_wakeup.clear()
+            self._sweeper_wakeup.wait(self._deadlines[0][0] - now if self._deadlines else None)
+
+    def _make_request(self, method, data, timeout):
         request = {
-            '__id': id_,
+            '__id': next(self._request_ids),
             '__method': method,
             '__params': data
         }
 
+        if timeout is None:
+            timeout = self.timeout
+
+        deadline = None
+        if timeout is not None:
+            request['__timeout'] = timeout
+            deadline = time.monotonic() + timeout
+
+        return request, deadline
+
+    def execute_rpc(self, method, data, timeout=None):
+        request, deadline = self._make_request(method, data, timeout)
+        id_ = request['__id']
+
         result = gevent.event.AsyncResult()
 
         try:
-            data = json.dumps(request).encode('utf-8')
-        except (TypeError, ValueError):
-            result.set_exception(RPCError('JSON serialization error'))
+            data = self.codec.dumps(request)
+        except CodecError:
+            result.set_exception(RPCError('Serialization error'))
             return result
 
+        # Registered before writing, the answer may arrive while the write is still yielding
+        pending = PendingRequest(method, result, deadline, self.metrics.method(method))
+        self._register(id_, pending, len(data))
+
         try:
             self._write(data)
         except OSError:
-            result.set_exception(RPCError('Write error'))
+            if self.pending_outgoing_requests.pop(id_, None) is not None:
+                self._complete(pending, error=RPCError('Write error'))
             return result
 
-        self.pending_outgoing_requests[id_] = request
-        self.pending_outgoing_requests_results[id_] = result
+        if deadline is not None and id_ in self.pending_outgoing_requests:
+            self._add_deadline(deadline, id_)
 
         return result
 
+    def execute_rpc_many(self, calls, timeout=None):
+        # calls is an iterable of (method, params) pairs, sent in one frame (or one flush for line-JSON peers)
+        results = []
+        requests = []
+        for method, data in calls:
+            request, deadline = self._make_request(method, data, timeout)
+            result = gevent.event.AsyncResult()
+            results.append(result)
+            requests.append((request, PendingRequest(method, result, deadline, self.metrics.method(method))))
+
+        if not requests:
+            return results
+
+        try:
+            if self.framed:
+                datas = [self.codec.dumps([request for request, _pending in requests])]
+            else:
+                datas = [self.codec.dumps(request) for request, _pending in requests]
+        except CodecError:
+            for result in results:
+                result.set_exception(RPCError('Serialization error'))
+            return results
+
+        size = sum(len(data) for data in datas) // len(requests)
+        for request, pending in requests:
+            self._register(request['__id'], pending, size)
+
+        try:
+            self._write_many(datas)
+        except OSError:
+            for request, pending in requests:
+                if self.pending_outgoing_requests.pop(request['__id'], None) is not None:
+                    self._complete(pending, error=RPCError('Write error'))
+            return results
+
+        for request, pending in requests:
+            if pending.deadline is not None and request['__id'] in self.pending_outgoing_requests:
+                self._add_deadline(pending.deadline, request['__id'])
+
+        return results
+
+    def batch(self, timeout=None):
+        return RPCBatch(self, timeout)
+
     def __getattr__(self, method):
         def run_callback(func, plus, result):
             data = result.value
@@ -359,10 +1102,119 @@ class RPCServiceClient(RPCServiceBase):
         def remote_method(**data):
             callback = data.pop("callback", None)
             plus = data.pop("plus", None)
-            result = self.execute_rpc(method, data)
+            timeout = data.pop("timeout", None)
+            result = self.execute_rpc(method, data, timeout=timeout)
             if callback is not None:
                 callback = functools.partial(run_callback, callback, plus)
                 result.rawlink(functools.partial(gevent.spawn, callback))
             return result
 
         return remote_method
+
+
+class RPCBatch:
+    # Collects calls made as batch.method(**params) and sends them together when the context exits:
+    #
+    #     with client.batch() as batch:
+    #         results = [batch.ping(string=str(i)) for i in range(500)]
+    #
+    def __init__(self, client, timeout=None):
+        self._client = client
+        self._timeout = timeout
+        self._calls = []
+        self._results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            for result in self._results:
+                result.set_exception(RPCError('Batch aborted'))
+            self._calls, self._results = [], []
+
+    def flush(self):
+        calls, results = self._calls, self._results
+        self._calls, self._results = [], []
+
+        for result, sent in zip(results, self._client.execute_rpc_many(calls, timeout=self._timeout)):
+            sent.rawlink(functools.partial(self._forward, result))
+
+    @staticmethod
+    def _forward(result, sent):
+        if sent.successful():
+            result.set(sent.value)
+        else:
+            result.set_exception(sent.exception)
+
+    def __getattr__(self, method):
+        def remote_method(**data):
+            result = gevent.event.AsyncResult()
+            self._calls.append((method, data))
+            self._results.append(result)
+            return result
+
+        return remote_method
+
+
+class RPCStream:
+    # Iterator over the items streamed back by a generator rpc_method. At most STREAM_WINDOW chunks are buffered,
+    # credits are returned to the server as they are consumed.
+    def __init__(self, client, id_, method, stats):
+        self._client = client
+        self._id = id_
+        self.method = method
+        self.stats = stats
+
+        self._chunks = collections.deque()
+        self._items = collections.deque()
+        self._consumed = 0
+        self._finished = False
+        self._error = None
+        self._event = gevent.event.Event()
+
+    def feed(self, chunk):
+        self._chunks.append(chunk)
+        self._event.set()
+
+    def finish(self, error=None):
+        self._finished = True
+        self._error = error
+        self._event.set()
+
+    def close(self):
+        if not self._finished:
+            self._client._send_stream_control(self._id, cancel=True)
+            self._client._streams.pop(self._id, None)
+            self.finish()
+        self._chunks.clear()
+        self._items.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self._items:
+            if self._chunks:
+                self._items.extend(self._chunks.popleft())
+                self._consumed += 1
+                if self._consumed >= STREAM_WINDOW // 2 and not self._finished:
+                    self._client._send_stream_control(self._id, credit=self._consumed)
+                    self._consumed = 0
+            elif self._finished:
+                if self._error is not None:
+                    raise self._error
+                raise StopIteration
+            else:
+                self._event.clear()
+                self._event.wait()
+
+        return self._items.popleft()
@@ -0,0 +1,140 @@
+import os
+import subprocess
+from datetime import datetime
+
+import gevent
+import gevent.queue
+from pony.orm import commit, count, db_session, select
+
+from utilities.models import Printing, User
+from utilities.services.metrics import Histogram
+
+# Run without a shell, the file name is passed as a single argument
+LPR_COMMAND = ('lpr', '-o', 'media=A4', '-o', 'prettyprint', '-o', 'fit-to-page')
+
+PENDING_STATES = ('queued', 'printing')
+
+
+def upload_name(job_id, source):
+    # Name of the job's file in the upload directory, source is the name shown to the contestant
+    return '%d_%s' % (job_id, source)
+
+
+def job_status(job):
+    # What a contestant polling their job sees, position is the number of queued jobs ahead of it
+    status = {
+        'id': job.id,
+        'file': job.source,
+        'state': job.state,
+        'created': job.created.isoformat(),
+        'started': job.started and job.started.isoformat(),
+        'finished': job.finished and job.finished.isoformat(),
+        'error': job.error or None,
+    }
+    if job.state == 'queued':
+        status['position'] = count(p for p in Printing if p.state == 'queued' and p.id < job.id)
+    return status
+
+
+class PrintSpooler:
+    # Sends print jobs to lpr from a fixed number of workers, so a burst of prints waits in the queue instead of
+    # starting an lpr for each one. Jobs are Printing rows, created while their file is uploaded and queued once it
+    # is on disk. Jobs left queued or printing when the service stopped are spooled again by start().
+    def __init__(self, directory, workers=2, timeout=60):
+        self.directory = directory
+        self.workers = workers
+        self.timeout = timeout  # Seconds lpr may take to hand a file to CUPS
+
+        self.queue = gevent.queue.Queue()
+        self._greenlets = []
+
+        self.active = 0
+        self.done = 0
+        self.failed = 0
+        self.queue_wait = Histogram()  # From the upload to a worker picking the job up
+        self.print_time = Histogram()
+        self.latency = Histogram()  # From the upload to lpr returning
+
+    def start(self):
+        with db_session:
+            for job in Printing.select(lambda p: p.state == 'uploading'):
+                job.set(state='failed', finished=datetime.now(), error='Upload interrupted')
+            pending = select(p.id for p in Printing if p.state in PENDING_STATES).order_by(1)[:]
+        for job_id in pending:
+            self.queue.put(job_id)
+        self._greenlets = [gevent.spawn(self._work) for _ in range(self.workers)]
+
+    def create(self, username, source):
+        # Returns the id of a new job waiting for its file, None if there is no such user
+        with db_session:
+            user = User.get(username=username)
+            if user is None:
+                return None
+            job = Printing(caller=user, source=source, state='uploading')
+            commit()
+            return job.id
+
+    def submit(self, job_id):
+        # The job's file is complete, from now on the job survives a restart
+        with db_session:
+            Printing[job_id].state = 'queued'
+        self.queue.put(job_id)
+
+    def abort(self, job_id, error):
+        with db_session:
+            Printing[job_id].set(state='failed', finished=datetime.now(), error=error)
+        self.failed += 1
+
+    def _work(self):
+        while True:
+            job_id = self.queue.get()
+            self.active += 1
+            try:
+                self._print(job_id)
+            except Exception as error:
+                # The job stays pending in the database and is spooled again on the next start
+                print("Cannot print job %d: %s" % (job_id, error))
+            finally:
+                self.active -= 1
+
+    def _print(self, job_id):
+        with db_session:
+            job = Printing.get(id=job_id)
+            if job is None or job.state not in PENDING_STATES:
+                return
+            job.set(state='printing', started=datetime.now())
+            source, created, started = job.source, job.created, job.started
+        self.queue_wait.record((started - created).total_seconds())
+
+        error = None
+        try:
+            result = subprocess.run(LPR_COMMAND + (os.path.join(self.directory, upload_name(job_id, source)),),
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=self.timeout)
+            if result.returncode != 0:
+                error = result.stderr.decode(errors='replace').strip() or 'lpr exited with %d' % result.returncode
+        except (OSError, subprocess.TimeoutExpired) as exception:
+            error = str(exception)
+        finished = datetime.now()
+
+        self.print_time.record((finished - started).total_seconds())
+        self.latency.record((finished - created).total_seconds())
+        if error is None:
+            self.done += 1
+        else:
+            self.failed += 1
+            print("Print job %d failed: %s" % (job_id, error))
+
+        with db_session:
+            Printing[job_id].set(state='done' if error is None else 'failed', finished=finished, error=error or '')
+
+    def as_dict(self):
+        return {
+            'workers': self.workers,
+            'active': self.active,
+            'queued': self.queue.qsize(),
+            'done': self.done,
+            'failed': self.failed,
+            'queue_wait': self.queue_wait.as_dict(),
+            'print_time': self.print_time.as_dict(),
+            'latency': self.latency.as_dict(),
+        }
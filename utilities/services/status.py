@@ -0,0 +1,127 @@
+import time
+from array import array
+
+from pony.orm import db_session, select
+
+from utilities.models import User
+
+
+class StatusRegistry:
+    # Live status of every user (online, ping, cpu, ram) kept in memory, in parallel arrays indexed by a slot per
+    # user. Readers are served from here, and only the users whose status changed are written back by flush().
+    # Every change takes the next version, so readers can ask for what changed since the version they last saw.
+    FIELDS = ('is_online', 'ping', 'cpu', 'ram')
+
+    def __init__(self):
+        self.slots = dict()  # user id -> slot
+        self.ids = array('q')
+        self.online = bytearray()
+        self.ping = array('d')
+        self.cpu = array('d')
+        self.ram = array('d')
+        self.versions = array('q')  # Version of the last change of each slot
+
+        # Starts from the clock, so versions keep increasing across restarts of the service
+        self.version = time.time_ns() // 1000
+
+        # Slots changed since the last flush
+        self.dirty = set()
+        # Called with the id of every user whose status changed
+        self.listeners = list()
+
+        self.flushes = 0
+        self.flushed_rows = 0
+
+    def load(self):
+        with db_session:
+            rows = select((u.id, u.is_online, u.ping, u.cpu, u.ram) for u in User)[:]
+        for id_, is_online, ping, cpu, ram in rows:
+            slot = self._slot(id_)
+            self.online[slot] = is_online
+            self.ping[slot] = ping
+            self.cpu[slot] = cpu
+            self.ram[slot] = ram
+
+    def _slot(self, id_):
+        slot = self.slots.get(id_)
+        if slot is None:
+            slot = self.slots[id_] = len(self.ids)
+            self.ids.append(id_)
+            self.online.append(0)
+            self.ping.append(-1.0)
+            self.cpu.append(0.0)
+            self.ram.append(0.0)
+            self.versions.append(0)
+        return slot
+
+    def _changed(self, slot):
+        self.version += 1
+        self.versions[slot] = self.version
+        self.dirty.add(slot)
+        for listener in self.listeners:
+            listener(self.ids[slot])
+
+    def touch(self, ids):
+        # Users whose name or address changed, readers asking for changes get them again
+        for id_ in ids:
+            self.version += 1
+            self.versions[self._slot(id_)] = self.version
+            for listener in self.listeners:
+                listener(id_)
+
+    def set_ping(self, id_, ping):
+        # ping in milliseconds, None when the user did not answer
+        slot = self._slot(id_)
+        online = ping is not None
+        ping = -1.0 if ping is None else ping
+        if self.online[slot] != online or self.ping[slot] != ping:
+            self.online[slot] = online
+            self.ping[slot] = ping
+            self._changed(slot)
+
+    def set_performance(self, id_, cpu, ram):
+        slot = self._slot(id_)
+        if self.cpu[slot] != cpu or self.ram[slot] != ram:
+            self.cpu[slot] = cpu
+            self.ram[slot] = ram
+            self._changed(slot)
+
+    def get(self, id_):
+        slot = self.slots.get(id_)
+        if slot is None:
+            return None
+        return {'is_online': bool(self.online[slot]), 'ping': self.ping[slot], 'cpu': self.cpu[slot],
+                'ram': self.ram[slot]}
+
+    def row(self, id_):
+        # (is_online, ping, cpu, ram) in FIELDS order, defaults for users never seen
+        slot = self.slots.get(id_)
+        if slot is None:
+            return False, -1.0, 0.0, 0.0
+        return bool(self.online[slot]), self.ping[slot], self.cpu[slot], self.ram[slot]
+
+    def changed_since(self, version):
+        return {self.ids[slot] for slot, changed in enumerate(self.versions) if changed > version}
+
+    def flush(self):
+        # Writes every changed user in a single transaction, returns how many rows were written
+        if not self.dirty:
+            return 0
+
+        dirty, self.dirty = self.dirty, set()
+        try:
+            with db_session:
+                for slot in dirty:
+                    user = User.get(id=self.ids[slot])
+                    if user is None:
+                        continue
+                    user.set(is_online=bool(self.online[slot]), ping=self.ping[slot], cpu=self.cpu[slot],
+                             ram=self.ram[slot])
+        except Exception:
+            # Written again with the next flush, together with whatever changed in between
+            self.dirty |= dirty
+            raise
+
+        self.flushes += 1
+        self.flushed_rows += len(dirty)
+        return len(dirty)
@@ -1,20 +1,30 @@
 from gevent import monkey
 monkey.patch_all()
 
+import ipaddress
 import signal
+import socket
 import os
+import time
 import requests
+import requests.adapters
 
-from ping3 import ping
-from flask import Flask, send_file
-from werkzeug.utils import secure_filename
+from flask import Flask, Response
 from flask_restful import Api, Resource, reqparse, request
-from pony.orm import db_session
+from pony.orm import db_session, desc
 
 import gevent
 
 from utilities.models import User, Printing
-from utilities.config import config
+from utilities.config import config, get_service_address, ServiceCoord
+from utilities.services.broadcast import USER_FIELDS, StatusBroadcaster, user_rows
+from utilities.services.configs import ConfigCache
+from utilities.services.directory import UserDirectory
+from utilities.services.icmp import Pinger, PingScheduler
+from utilities.services.passwords import PasswordVerifier, VerifierBusy
+from utilities.services.rpc import rpc_method
+from utilities.services.spooler import job_status
+from utilities.services.status import StatusRegistry
 
 import logging
 log = logging.getLogger('werkzeug')
@@ -24,7 +34,14 @@ app = Flask(__name__)
 api = Api(app)
 
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1000 * 1000
-app.config['UPLOAD_FOLDER'] = os.path.join('data', 'uploads')
+
+PRINT_CHUNK_SIZE = 64 * 1024
+PRINT_JOBS_SHOWN = 10
+
+# Connections to the printing service are kept alive and reused by every print request
+printing_session = requests.Session()
+printing_session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=32))
+
 
 @app.route('/')
 def default():
@@ -32,9 +49,7 @@ def default():
 
 
 def rpc_method_user(method):
-    method.rpc = True
-    method.permission = 'user'
-    return method
+    return rpc_method(method, permission='user')
 
 
 @api.resource('/login')
@@ -51,42 +66,80 @@ class UserLogin(Resource):
         args = self.parser.parse_args()
         username = args['username'] or ""
         password = args['password'] or ""
-        user = User.select(lambda u: u.username == username).first()
+        entry = directory.by_username(username)
+        user = None if entry is None else User.get(id=entry.id)
 
         if not user:
             return {'error': 'User not found'}, 404
-        elif not user.verify_password(password):
+
+        # bcrypt takes hundreds of milliseconds, it runs on the verifier's threads instead of blocking the loop
+        try:
+            verified = verifier.verify(user.password, password)
+        except VerifierBusy:
+            return {'error': 'Too many logins at once, please retry'}, 503
+
+        if not verified:
             return {'error': 'Incorrect password'}, 401
-        elif not os.path.exists(os.path.join('data', 'configs', f'{username}.conf')):
+
+        # WireGuard .conf or tinc .zip, served from memory
+        vpn_config = configs.get(user.username)
+        if vpn_config is None:
             return {'error': 'User configuration not found'}, 404
 
-        # TODO: Return VPN configurations
-        return send_file(os.path.join('..', '..', 'data', 'configs', f'{username}.conf'))
+        headers = {'ETag': '"%s"' % vpn_config.etag, 'Cache-Control': 'private, no-cache'}
+        if request.if_none_match.contains(vpn_config.etag):
+            return Response(status=304, headers=headers)
+
+        headers['Content-Disposition'] = 'attachment; filename="%s"' % vpn_config.filename
+        return Response(vpn_config.data, mimetype=vpn_config.mimetype, headers=headers)
 
 
 @api.resource('/print')
 class Print(Resource):
-    @db_session
+    def get(self):
+        # Polled by contestants for the state of their latest print jobs
+        entry = directory.by_ip(request.remote_addr)
+        if not entry:
+            return {'error': 'User not found'}, 404
+
+        with db_session:
+            jobs = Printing.select(lambda p: p.caller.id == entry.id).order_by(desc(Printing.id))[:PRINT_JOBS_SHOWN]
+            return {'jobs': [job_status(job) for job in jobs]}, 200
+
     def post(self):
-        ip = request.remote_addr
-        user = User.select(lambda u: u.ip_address == ip).first()
+        user = directory.by_ip(request.remote_addr)
         if not user:
             return {'error': 'User not found'}, 404
 
-        file = request.files['file']
-        if file.filename == '':
-            return {'error': 'No file selected'}, 400
-
-        if file:
-            filename = f'{user.username}_{secure_filename(file.filename)}'
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            Printing(caller=user, source=filename)
-            service_address = config['services']['PrintingService'][0]
-            r = requests.post(f'http://{service_address[0]}:{service_address[1]}/print',
-                              files={'file': open(os.path.join(app.config['UPLOAD_FOLDER'], filename), 'rb')}, timeout=5)
-            return {'success': True}, 200
-        else:
-            return {'error': 'No file selected'}, 400
+        # The multipart body is not parsed here but streamed to the printing service as it arrives, which parses
+        # it and checks the file
+        address = get_service_address(ServiceCoord('PrintingService', 0))
+        try:
+            response = printing_session.post(
+                f'http://{address.host}:{address.port}/print',
+                data=iter(lambda: request.stream.read(PRINT_CHUNK_SIZE), b''),
+                headers={'Content-Type': request.content_type, 'X-Print-User': user.username},
+                timeout=(5, 30))
+        except requests.RequestException as error:
+            print("Cannot send a file of %s to the printing service: %s" % (user.username, error))
+            return {'error': 'Printing service unavailable'}, 502
+
+        try:
+            result = response.json()
+        except ValueError:
+            result = None
+        if not isinstance(result, dict):
+            print("Invalid answer of the printing service: %d %r" % (response.status_code, response.text[:200]))
+            return {'error': 'Printing service unavailable'}, 502
+        if not response.ok or 'job' not in result:
+            # e.g. no file selected, passed on to the contestant
+            if 400 <= response.status_code < 500 and 'error' in result:
+                return {'error': result['error']}, response.status_code
+            print("Printing service failed: %d %r" % (response.status_code, result))
+            return {'error': 'Printing service unavailable'}, 502
+
+        # The printing service answers once the file is on its disk and the job is queued
+        return {'success': True, 'job': result['job']}, 200
 
 
 @api.resource('/performance')
@@ -97,47 +150,75 @@ class Performance(Resource):
         self.parser.add_argument('cpu', location='form')
         self.parser.add_argument('mem', location='form')
 
-    @db_session
     def post(self):
-        ip = request.remote_addr
-        user = User.select(lambda u: u.ip_address == ip).first()
+        user = directory.by_ip(request.remote_addr)
         if not user:
             return {'error': 'User not found'}, 404
 
         args = self.parser.parse_args()
-        cpu = args['cpu'] or ""
-        mem = args['mem'] or ""
-        user.cpu = cpu
-        user.ram = mem
+        try:
+            cpu = float(args['cpu'] or 0.0)
+            mem = float(args['mem'] or 0.0)
+        except ValueError:
+            return {'error': 'Invalid performance data'}, 400
+        # Written to the database by the status flusher
+        statuses.set_performance(user.id, cpu, mem)
         return {'success': True}, 200
 
 
+pinger = Pinger(timeout=config.get('ping_timeout', 4))
+scheduler = PingScheduler(config.get('ping_interval', 5))
+statuses = StatusRegistry()
+directory = UserDirectory(on_change=statuses.touch)
+broadcaster = StatusBroadcaster(statuses, directory)
+verifier = PasswordVerifier(config.get('login_threads'))
+configs = ConfigCache(os.path.join('data', 'configs'))
+
+
 def ping_users():
     while True:
-        with db_session:
-            users = User.select()
-            batch_size = 5
-            batch = []
-            for i in range(0, len(users), batch_size):
-                # Create a gevnet batch
-                batch.append(gevent.spawn(ping_batch, users[i:i + batch_size]))
-            gevent.joinall(batch)
-        print("DONE")
-
-
-def ping_batch(batch):
-    with db_session:
-        for user in batch:
-            try:
-                ping_ = ping(user.ip_address)
-            except:
-                ping_ = False
-            if not ping_:
-                user.is_online = False
-                user.ping = -1.0
-            else:
-                user.is_online = True
-                user.ping = round(ping_ * 1000.0, 2)
+        addresses = directory.addresses()
+        scheduler.update(addresses)
+
+        # Sleeps until the next host is due, but wakes up at least every interval to pick up reloaded users
+        now = time.monotonic()
+        next_due = scheduler.next_due()
+        if next_due is None or next_due > now + scheduler.slack:
+            gevent.sleep(scheduler.interval if next_due is None else min(next_due - now, scheduler.interval))
+            continue
+
+        # One sweep pings every due host at once, it lasts about ping_timeout however many are offline
+        hosts = scheduler.pop_due(now)
+        try:
+            results = pinger.sweep(hosts)
+        except OSError as error:
+            print("Cannot ping users: %s" % error)
+            results = {host: None for host in hosts}
+        scheduler.record(results, now)
+        ping_batch(addresses, results)
+
+
+def ping_batch(addresses, results):
+    for host, ping_ in results.items():
+        if host in addresses:
+            statuses.set_ping(addresses[host], None if ping_ is None else round(ping_ * 1000.0, 2))
+
+
+def flush_statuses():
+    # Live status changes many times per second, it is written back in one transaction every few seconds
+    while True:
+        gevent.sleep(config.get('status_flush_interval', 5))
+        try:
+            statuses.flush()
+        except Exception as error:
+            print("Cannot save user statuses: %s" % error)
+
+
+@api.resource('/ping_stats')
+class PingStats(Resource):
+    def get(self):
+        # How far the ping scheduler is falling behind, see PingScheduler
+        return scheduler.as_dict(), 200
 
 
 @api.resource('/user/<string:username>')
@@ -146,20 +227,92 @@ class UserInfo(Resource):
         super().__init__()
 
     def get(self, username):
-        with db_session:
-            user = User.select(lambda u: u.username == username).first()
-            if not user:
-                return {'error': 'User not found'}, 404
-            return {'username': user.username, 'ip_address': user.ip_address, 'is_online': user.is_online}, 200
+        user = directory.by_username(username)
+        if not user:
+            return {'error': 'User not found'}, 404
+        status = statuses.get(user.id)
+        return {'username': user.username, 'ip_address': user.ip_address,
+                'is_online': status is not None and status['is_online']}, 200
+
+
+@api.resource('/users')
+class Users(Resource):
+    def get(self):
+        # Every user's status in one response. Pollers send back the ETag to get a 304 while nothing changed, or pass
+        # ?since=<version> to only get the users that changed after the version of their previous response.
+        version = statuses.version
+        etag = str(version)
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers={'ETag': '"%s"' % etag})
+
+        since = request.args.get('since', type=int)
+        if since is not None and since > version:
+            # From before a restart with a clock set back, start over
+            since = None
+        changed = None if since is None else statuses.changed_since(since)
+
+        users = user_rows(statuses, directory, changed)
+        return {'version': version, 'fields': USER_FIELDS, 'users': users}, 200, {'ETag': '"%s"' % etag}
+
+
+@app.route('/users/events')
+def user_events():
+    # Server-Sent Events: a snapshot of every user, then status changes as they happen
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    return Response(broadcaster.stream(last_event_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/login/stats')
+def login_stats():
+    # Time logins wait for a thread vs time spent hashing
+    return dict(verifier.as_dict(), configs=configs.as_dict())
+
+
+@app.route('/users/events/stats')
+def user_events_stats():
+    return broadcaster.as_dict()
+
+
+def from_this_host(address):
+    # Loopback, or the address the api is bound to: scripts on this host connect from it when the api only listens
+    # on e.g. the VPN address
+    address = ipaddress.ip_address(address)
+    if address.is_loopback:
+        return True
+    try:
+        return address == ipaddress.ip_address(socket.gethostbyname(config['api'][0]))
+    except (OSError, ValueError):
+        return False
+
+
+@api.resource('/user_directory')
+class UserDirectoryResource(Resource):
+    def get(self):
+        return directory.as_dict(), 200
+
+    def post(self):
+        # Called by the provisioning scripts after they changed users, see notify_users_changed
+        if not from_this_host(request.remote_addr):
+            return {'error': 'Permission denied'}, 403
+        directory.load()
+        return directory.as_dict(), 200
 
 
 def exit():
-    os._exit(0)
+    try:
+        statuses.flush()
+    finally:
+        os._exit(0)
 
 
 ping_thread = None
+flush_thread = None
 gevent.signal_handler(signal.SIGINT, exit)
 
 def main():
-    global ping_thread
+    global ping_thread, flush_thread
+    directory.load()
+    statuses.load()
     ping_thread = gevent.spawn(ping_users)
+    flush_thread = gevent.spawn(flush_statuses)